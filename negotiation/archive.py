@@ -0,0 +1,64 @@
+# coding=utf-8
+"""
+Archival of closed negotiations: each one is replaced by a NegotiationArchive row holding its whole history in a
+compressed blob, and its proposals, workflow history, local roles and object permissions are deleted, keeping the hot
+tables small.
+"""
+from datetime import timedelta
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils.timezone import now
+from permissions.models import ObjectPermission, PrincipalRoleRelation
+from workflows.models import WorkflowHistorical
+import serializers
+from models import Negotiation, NegotiationArchive, NegotiationInbox, NegotiationProposal, history_records, \
+    ACCEPTED, CANCELLED
+
+
+def archivable(days):
+    """
+    Returns the closed (accepted or cancelled) negotiations not updated for the last 'days' days.
+    """
+    return Negotiation.objects.filter(state_code__in=(ACCEPTED, CANCELLED), updated__lt=now() - timedelta(days=days))
+
+
+def archive_negotiations(negotiations):
+    """
+    Archives the passed negotiations (loaded along with their current state) in a single transaction, with a fixed
+    number of queries (plus one for each negotiation not backfilled yet, see history_records()). Returns the number of
+    negotiations archived.
+    """
+    negotiations = list(negotiations)
+    if not negotiations:
+        return 0
+    ids = [negotiation.pk for negotiation in negotiations]
+    with transaction.atomic():
+        histories = history_records(negotiations)
+        NegotiationArchive.objects.bulk_create([NegotiationArchive(
+            content_type_id=negotiation.content_type_id,
+            content_pk=negotiation.content_pk,
+            starter_id=negotiation.starter_id,
+            client_id=negotiation.client_id,
+            seller_id=negotiation.seller_id,
+            state=negotiation.current_state.name,
+            notes=negotiation.notes,
+            last_updater_user_id=negotiation.last_updater_user_id,
+            last_updater_role_id=negotiation.last_updater_role_id,
+            rounds=negotiation.rounds,
+            updated=negotiation.updated,
+            history_blob=NegotiationArchive.encode_history([
+                [updater, role, transition, updated.isoformat(), notes, serializers.dumps(content)]
+                for updater, role, transition, updated, notes, content in histories[negotiation.pk]
+            ])
+        ) for negotiation in negotiations])
+
+        negotiation_ctype = ContentType.objects.get_for_model(Negotiation)
+        ObjectPermission.objects.filter(content_type=negotiation_ctype, content_id__in=ids).delete()
+        PrincipalRoleRelation.objects.filter(content_type=negotiation_ctype, content_id__in=ids).delete()
+        WorkflowHistorical.objects.filter(content_type=negotiation_ctype, content_id__in=ids).delete()
+        # the latest proposal pointers would make the proposals and negotiations delete each other in cascade
+        Negotiation.objects.filter(pk__in=ids).update(latest_client_proposal=None, latest_seller_proposal=None)
+        NegotiationProposal.objects.filter(negotiation__in=ids).delete()
+        NegotiationInbox.objects.filter(negotiation__in=ids).delete()
+        Negotiation.objects.filter(pk__in=ids).delete()
+    return len(negotiations)
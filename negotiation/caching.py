@@ -0,0 +1,138 @@
+# coding=utf-8
+"""
+Two-level cache for the negotiation constants (roles, permissions, workflow and transitions): an in-process dict in
+front of the shared Django cache. Shared cache keys are versioned with NEGOTIATION_CACHE_VERSION and with a
+generation number that flush() increases, so every process stops using the flushed values.
+
+Also, versioned fragment cache for the rendered member lists of the negotiation parts, and cache of the number of
+negotiations pending for each user.
+"""
+import time
+from functools import wraps
+from django.core.cache import cache
+from instrumentation import count
+from settings import NEGOTIATION_CACHE_VERSION, NEGOTIATION_LOCAL_CACHE_TIMEOUT, NEGOTIATION_MEMBERS_CACHE_TIMEOUT, \
+    NEGOTIATION_PENDING_COUNT_CACHE_TIMEOUT
+
+GENERATION_KEY = 'NEGOTIATION_CACHE_GENERATION'
+
+_local = {}
+_loaders = {}
+
+
+def _version():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        generation = 1
+        cache.add(GENERATION_KEY, generation, None)
+    return '%s.%s' % (NEGOTIATION_CACHE_VERSION, generation)
+
+
+def cached_constant(key):
+    """
+    Decorates a function without arguments that loads a constant from the database, so the value is served from the
+    in-process cache, then from the shared cache, and only loaded when neither has it. None values are not cached.
+    """
+    def decorator(loader):
+        @wraps(loader)
+        def get():
+            entry = _local.get(key)
+            if entry is not None and entry[1] > time.time():
+                count('cache.%s.local_hit' % key.lower())
+                return entry[0]
+            version = _version()
+            value = cache.get(key, version=version)
+            if value is not None:
+                count('cache.%s.shared_hit' % key.lower())
+            else:
+                count('cache.%s.miss' % key.lower())
+                value = loader()
+                if value is None:
+                    return None
+                cache.set(key, value, None, version=version)
+            _local[key] = (value, time.time() + NEGOTIATION_LOCAL_CACHE_TIMEOUT)
+            return value
+        _loaders[key] = get
+        return get
+    return decorator
+
+
+def warm():
+    """
+    Loads every registered constant into both cache levels. Returns the keys that could not be loaded.
+    """
+    return [key for key, get in sorted(_loaders.items()) if get() is None]
+
+
+def flush():
+    """
+    Drops the constants from the in-process cache and invalidates them in the shared cache.
+    """
+    _local.clear()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:  # the generation key was evicted (or never set)
+        cache.set(GENERATION_KEY, 2, None)
+
+
+def _members_version_key(group_pk):
+    return 'NEGOTIATION_MEMBERS_VERSION:%s' % group_pk
+
+
+def members_version(group_pk):
+    """
+    Returns the current version of the members of a group, which changes whenever they (or their names) change.
+    """
+    key = _members_version_key(group_pk)
+    version = cache.get(key)
+    if version is None:
+        # start from a new value, so fragments cached before the version was evicted are never reused
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_members_version(group_pks):
+    for group_pk in group_pks:
+        try:
+            cache.incr(_members_version_key(group_pk))
+        except ValueError:  # no fragment was cached with the current version
+            pass
+
+
+def cached_members(kind, group_pk, render, *args):
+    """
+    Returns the member list of the group 'group_pk' rendered by 'render', cached by (kind, args) and members version.
+    """
+    key = 'NEGOTIATION_MEMBERS:%s:%s:%s:%s' % (kind, group_pk, members_version(group_pk), ':'.join(args))
+    rendered = cache.get(key)
+    if rendered is not None:
+        count('cache.%s.hit' % kind)
+    else:
+        count('cache.%s.miss' % kind)
+        rendered = render()
+        cache.set(key, rendered, NEGOTIATION_MEMBERS_CACHE_TIMEOUT)
+    return rendered
+
+
+def _pending_count_key(user_pk):
+    return 'NEGOTIATION_PENDING_COUNT:%s' % user_pk
+
+
+def cached_pending_count(user_pk, load):
+    """
+    Returns the number of negotiations pending for the user 'user_pk', counted by 'load' when it is not cached.
+    """
+    key = _pending_count_key(user_pk)
+    pending_count = cache.get(key)
+    if pending_count is not None:
+        count('cache.pending_count.hit')
+    else:
+        count('cache.pending_count.miss')
+        pending_count = load()
+        cache.set(key, pending_count, NEGOTIATION_PENDING_COUNT_CACHE_TIMEOUT)
+    return pending_count
+
+
+def forget_pending_counts(user_pks):
+    cache.delete_many([_pending_count_key(user_pk) for user_pk in user_pks])
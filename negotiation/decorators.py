@@ -1,19 +1,73 @@
 # coding=utf-8
+from collections import Counter
 from django.contrib.contenttypes.generic import GenericRelation
-from django.contrib.auth.models import Group
-from models import Negotiation, NegotiationPart
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.auth.models import Group, User
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Q
+from django.utils.timezone import now
+from permissions.models import ObjectPermission, PrincipalRoleRelation
+from instrumentation import instrument
+import serializers
+from models import Negotiation, NegotiationArchive, NegotiationAutoGroup, NegotiationPart, NegotiationProposal, \
+    START_TRANSITION, client_role, seller_role, counterpart_permission, last_updater_permission, negotiation_workflow, \
+    refresh_inboxes, STATE_CODES, NEGOTIATING, ACCEPTED, CANCELLED
+import settings
+from settings import NEGOTIATION_USER_GROUP_NAME
 
 
 class ExtendedNegotiableQuerysetMixin(object):
 
     def negotiating(self):
-        return self.filter(negotiations__current_state__name='Negotiating')
+        return self.filter(negotiations__state_code=NEGOTIATING)
 
+    # closed negotiations may have been archived (see negotiation_archive)
     def accepted(self):
-        return self.filter(negotiations__current_state__name='Accepted')
+        return self.filter(Q(negotiations__state_code=ACCEPTED) | Q(negotiation_archives__state='Accepted'))
 
     def cancelled(self):
-        return self.filter(negotiations__current_state__name='Cancelled')
+        return self.filter(Q(negotiations__state_code=CANCELLED) | Q(negotiation_archives__state='Cancelled'))
+
+    def state_counts(self):
+        """
+        Returns a {state name: number of objects} dict with the number of objects of this queryset in each state of
+        their negotiation (archived or not), counted with a single GROUP BY query. Objects without negotiation are not
+        counted.
+        """
+        counts = dict((name, 0) for name in STATE_CODES)
+        names = dict((code, name) for name, code in STATE_CODES.items())
+        rows = self.order_by().values_list('negotiations__state_code', 'negotiation_archives__state')
+        for code, archived_state, count in rows.annotate(count=Count('pk')):
+            name = names.get(code, archived_state)
+            if name in counts:
+                counts[name] += count
+        return counts
+
+    def with_negotiation(self):
+        """
+        Prefetches the negotiation of each object, along with its state, parts and starter (or its archive).
+        """
+        return self.prefetch_related(
+            'negotiations__current_state', 'negotiations__client', 'negotiations__seller', 'negotiations__starter',
+            'negotiation_archives'
+        )
+
+    def with_negotiation_members(self):
+        """
+        Prefetches the negotiation of each object like with_negotiation does, plus the members of both parts.
+        """
+        return self.with_negotiation().prefetch_related(
+            'negotiations__client__user_set', 'negotiations__seller__user_set'
+        )
+
+    def with_status_for(self, user):
+        """
+        Evaluates the queryset and returns its objects, each one with the 'negotiation_status' and
+        'negotiation_transitions' of 'user' attached, computed for the whole list with a fixed number of queries.
+        """
+        objects = list(self)
+        attach_statuses(objects, user, Negotiation.objects.statuses_for(user, objects))
+        return objects
 
 
 class ExtendedNegotiableManagerMixin(object):
@@ -27,34 +81,221 @@ class ExtendedNegotiableManagerMixin(object):
     def cancelled(self):
         return self.get_queryset().cancelled()
 
+    def state_counts(self):
+        return self.get_queryset().state_counts()
+
+    def with_negotiation(self):
+        return self.get_queryset().with_negotiation()
+
+    def with_negotiation_members(self):
+        return self.get_queryset().with_negotiation_members()
+
+    def with_status_for(self, user):
+        return self.get_queryset().with_status_for(user)
+
+    def bulk_negotiate(self, negotiations, chunk_size=500):
+        """
+        Starts a negotiation for each (negotiable, client, seller, notes) tuple of the passed iterable, like calling
+        negotiate() on every negotiable, but writing the groups, negotiations, proposals, local roles and permissions
+        with bulk inserts, in one transaction per chunk. Negotiables that already have a negotiation are skipped.
+        Returns the number of negotiations started.
+        """
+        count, chunk = 0, []
+        for item in negotiations:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                count += _bulk_negotiate(self.model, chunk)
+                chunk = []
+        if chunk:
+            count += _bulk_negotiate(self.model, chunk)
+        return count
+
+
+# the other manager and queryset methods are lazy: their queries run (and are measured) wherever they are evaluated
+instrument(ExtendedNegotiableManagerMixin, 'negotiable.objects', ['state_counts', 'with_status_for', 'bulk_negotiate'])
+instrument(ExtendedNegotiableQuerysetMixin, 'negotiable.objects', ['state_counts', 'with_status_for'])
+
+
+def _point_latest_proposals(negotiation_ids):
+    # bulk_create does not set primary keys, so let the database resolve the summary pointers (one query per side)
+    qn = connection.ops.quote_name
+    negotiation_table, proposal_table = qn(Negotiation._meta.db_table), qn(NegotiationProposal._meta.db_table)
+    for role, field in ((client_role(), 'latest_client_proposal'), (seller_role(), 'latest_seller_proposal')):
+        sql = (
+            "UPDATE %(negotiation)s SET %(pointer)s = ("
+            "SELECT MAX(%(proposal)s.id) FROM %(proposal)s "
+            "WHERE %(proposal)s.negotiation_id = %(negotiation)s.id AND %(proposal)s.role_id = %%s"
+            ") WHERE %(negotiation)s.id IN (%(ids)s)"
+        ) % {
+            'negotiation': negotiation_table,
+            'proposal': proposal_table,
+            'pointer': qn(Negotiation._meta.get_field(field).column),
+            'ids': ', '.join(['%s'] * len(negotiation_ids)),
+        }
+        connection.cursor().execute(sql, [role.pk] + list(negotiation_ids))
+
+
+def _bulk_negotiate(model, items):
+    ctype = ContentType.objects.get_for_model(model)
+    started = set(Negotiation.objects.filter(
+        content_type=ctype, content_pk__in=[item[0].pk for item in items]
+    ).values_list('content_pk', flat=True))
+    pending = {}
+    for item in items:
+        if item[0].pk not in started:
+            pending.setdefault(item[0].pk, item)  # only one instance of negotiation allowed per negotiable object
+    items = list(pending.values())
+    if not items:
+        return 0
+
+    with transaction.atomic():
+        # parts given as users get a group of their own, like negotiate() does
+        part_users, group_names = {}, {}
+        for obj, client, seller, notes in items:
+            for part, suffix in ((client, "client"), (seller, "seller")):
+                if not isinstance(part, Group):
+                    part_users[(obj.pk, suffix)] = part
+                    group_names[(obj.pk, suffix)] = NEGOTIATION_USER_GROUP_NAME % part.pk \
+                        if settings.NEGOTIATION_REUSE_USER_GROUPS else "%s-%s" % (str(obj), suffix)
+        if settings.NEGOTIATION_REUSE_USER_GROUPS:
+            group_ids = dict(Group.objects.filter(
+                name__in=set(group_names.values())
+            ).values_list('name', 'pk'))
+        else:
+            # every part gets a new group, so (like negotiate()) their names must not be taken yet
+            names = Counter(group_names.values())
+            taken = set(name for name, count in names.items() if count > 1)
+            taken.update(Group.objects.filter(name__in=list(names)).values_list('name', flat=True))
+            if taken:
+                raise IntegrityError("Negotiation part groups already exist: %s." % ", ".join(sorted(taken)))
+            group_ids = {}
+        # the user of each new group (reused groups are named after their single user)
+        new_groups = dict((name, part_users[key]) for key, name in group_names.items() if name not in group_ids)
+        Group.objects.bulk_create([Group(name=name) for name in new_groups])
+        group_ids.update(Group.objects.filter(name__in=list(new_groups)).values_list('name', 'pk'))
+        NegotiationAutoGroup.objects.bulk_create([
+            NegotiationAutoGroup(group_id=group_ids[name]) for name in new_groups
+        ])
+        membership = User.groups.through
+        membership.objects.bulk_create([
+            membership(user_id=user.pk, group_id=group_ids[name]) for name, user in new_groups.items()
+        ])
+        memberships = set((user.pk, group_ids[group_names[key]]) for key, user in part_users.items())
+
+        parts = {}
+        for obj, client, seller, notes in items:
+            parts[obj.pk] = tuple(
+                part.pk if isinstance(part, Group) else group_ids[group_names[(obj.pk, suffix)]]
+                for part, suffix in ((client, "client"), (seller, "seller"))
+            )
+        memberships.update(membership.objects.filter(
+            user__in=set(obj.creator.pk for obj, _, _, _ in items),
+            group__in=set(client_id for client_id, _ in parts.values())
+        ).values_list('user_id', 'group_id'))
+
+        initial_state = negotiation_workflow().initial_state
+        timestamp = now()
+        negotiations, proposals, acting_roles = [], {}, {}
+        for obj, client, seller, notes in items:
+            obj.__dict__.pop('_negotiation_cache', None)  # may hold a missing negotiation
+            client_id, seller_id = parts[obj.pk]
+            acting_roles[obj.pk] = client_role() if (obj.creator.pk, client_id) in memberships else seller_role()
+            negotiations.append(Negotiation(
+                content_type=ctype,
+                content_pk=obj.pk,
+                starter=obj.creator,
+                client_id=client_id,
+                seller_id=seller_id,
+                notes=notes,
+                current_state=initial_state,
+                state_code=STATE_CODES.get(initial_state.name),
+                last_updater_user=obj.creator,
+                last_updater_role=acting_roles[obj.pk],
+                rounds=1,
+                last_transition_at=timestamp
+            ))
+            proposals[obj.pk] = NegotiationProposal(
+                actor=obj.creator,
+                role=acting_roles[obj.pk],
+                transition=START_TRANSITION,
+                created=timestamp,
+                notes=notes,
+                content=serializers.dumps(obj.freeze())
+            )
+        Negotiation.objects.bulk_create(negotiations)
+        negotiation_ids = dict(Negotiation.objects.filter(
+            content_type=ctype, content_pk__in=parts.keys()
+        ).values_list('content_pk', 'pk'))
+
+        for content_pk, proposal in proposals.items():
+            proposal.negotiation_id = negotiation_ids[content_pk]
+        NegotiationProposal.objects.bulk_create(list(proposals.values()))
+        _point_latest_proposals(list(negotiation_ids.values()))
+        refresh_inboxes(negotiation_ids.values())
+
+        # local roles of each part, and the initial permissions set by Negotiation.init_permissions
+        negotiation_ctype = ContentType.objects.get_for_model(Negotiation)
+        local_roles, object_permissions = [], []
+        for content_pk, negotiation_id in negotiation_ids.items():
+            for group_id, role in zip(parts[content_pk], (client_role(), seller_role())):
+                local_roles.append(PrincipalRoleRelation(
+                    group_id=group_id, role=role, content_type=negotiation_ctype, content_id=negotiation_id
+                ))
+                if settings.NEGOTIATION_TURN_BASED:
+                    permissions = (last_updater_permission(), counterpart_permission())
+                elif role == acting_roles[content_pk]:
+                    permissions = (last_updater_permission(),)
+                else:
+                    permissions = (counterpart_permission(),)
+                object_permissions.extend(ObjectPermission(
+                    role=role, permission=permission, content_type=negotiation_ctype, content_id=negotiation_id
+                ) for permission in permissions)
+        PrincipalRoleRelation.objects.bulk_create(local_roles)
+        ObjectPermission.objects.bulk_create(object_permissions)
+    return len(negotiation_ids)
+
+
+_NOT_ATTACHED = object()
+
+
+def attach_statuses(objects, user, statuses):
+    """
+    Attaches to each object its 'negotiation_status' and 'negotiation_transitions' for 'user', from a
+    {negotiable pk: (status, transitions)} dict. status_for() and negotiation_options() then return them for that user.
+    """
+    for obj in objects:
+        obj.negotiation_status, obj.negotiation_transitions = statuses.get(obj.pk, (None, []))
+        obj._negotiation_status_user = user.pk
+
 
 def negotiate(self, client, seller, notes):
     if self.negotiation is not None:
         return  # only one instance of negotiation allowed per negotiable object
 
-    if not isinstance(client, Group):
-        group = Group.objects.create(name="%s-%s" % (str(self), "client"))
-        group.user_set.add(client)
-        client = group
-    if not isinstance(client, NegotiationPart):
-        client = NegotiationPart(client.pk)
-
-    if not isinstance(seller, Group):
-        group = Group.objects.create(name="%s-%s" % (str(self), "seller"))
-        group.user_set.add(seller)
-        seller = group
-    if not isinstance(seller, NegotiationPart):
-        seller = NegotiationPart(seller.pk)
-
-    new_negotiation = Negotiation(
-        starter=self.creator,
-        content=self,
-        client=client,
-        seller=seller,
-        notes=notes
-    )
-    new_negotiation.save(user=self.creator, comment=new_negotiation.history_comment)
-    new_negotiation.init_permissions()
+    with transaction.atomic():
+        if not isinstance(client, Group):
+            client = NegotiationPart.for_user(client, "%s-%s" % (str(self), "client"))
+        if not isinstance(client, NegotiationPart):
+            client = NegotiationPart(client.pk)
+
+        if not isinstance(seller, Group):
+            seller = NegotiationPart.for_user(seller, "%s-%s" % (str(self), "seller"))
+        if not isinstance(seller, NegotiationPart):
+            seller = NegotiationPart(seller.pk)
+
+        new_negotiation = Negotiation(
+            starter=self.creator,
+            content=self,
+            client=client,
+            seller=seller,
+            notes=notes
+        )
+        content_dict = self.freeze()
+        new_negotiation.save(user=self.creator, comment=new_negotiation._history_comment(content_dict))
+        new_negotiation.record_proposal(self.creator, START_TRANSITION, content_dict)
+        new_negotiation.init_permissions()
+        refresh_inboxes([new_negotiation.pk])
+    self._negotiation_cache = new_negotiation
     return True
 
 
@@ -70,9 +311,21 @@ def creator(self):
 @property
 def negotiation(self):
     try:
-        return self.negotiations.all()[0]
+        return self._negotiation_cache
+    except AttributeError:
+        pass
+    try:
+        # served from the prefetched results when the queryset used with_negotiation()
+        negotiation = self.negotiations.all()[0]
     except IndexError:
-        return None
+        try:
+            negotiation = self.negotiation_archives.all()[0]  # closed and archived (see negotiation_archive)
+        except IndexError:
+            self._negotiation_cache = None  # until negotiate() is called
+            return None
+    negotiation.content = self  # spare the generic foreign key lookup of this same instance
+    self._negotiation_cache = negotiation
+    return negotiation
 
 
 @property
@@ -108,6 +361,8 @@ def is_accepted(self):
 
 
 def status_for(self, user):
+    if getattr(self, '_negotiation_status_user', _NOT_ATTACHED) == user.pk:
+        return self.negotiation_status
     try:
         return self.negotiation.status_for(user)
     except AttributeError:
@@ -115,6 +370,7 @@ def status_for(self, user):
 
 
 def accept(self, user, notes="", **kwargs):
+    self.__dict__.pop('_negotiation_status_user', None)  # the attached status will change
     try:
         return self.negotiation.accept(user, notes, **kwargs)
     except AttributeError:
@@ -122,6 +378,7 @@ def accept(self, user, notes="", **kwargs):
 
 
 def cancel(self, user, notes="", **kwargs):
+    self.__dict__.pop('_negotiation_status_user', None)  # the attached status will change
     try:
         return self.negotiation.cancel(user, notes, **kwargs)
     except AttributeError:
@@ -129,6 +386,7 @@ def cancel(self, user, notes="", **kwargs):
 
 
 def counter_proposal(self, user, notes="", **kwargs):
+    self.__dict__.pop('_negotiation_status_user', None)  # the attached status will change
     try:
         return self.negotiation.negotiate(user, notes, **kwargs)
     except AttributeError:
@@ -136,6 +394,7 @@ def counter_proposal(self, user, notes="", **kwargs):
 
 
 def modify_proposal(self, user, notes="", **kwargs):
+    self.__dict__.pop('_negotiation_status_user', None)  # the attached status will change
     try:
         return self.negotiation.modify(user, notes, **kwargs)
     except AttributeError:
@@ -209,20 +468,31 @@ def is_last_updater(self, user):
         return False
 
 
-def history(self, recent_first=True):
+def history(self, recent_first=True, limit=None, before=None, after=None, before_id=None, after_id=None):
     try:
-        return self.negotiation.history(recent_first)
+        return self.negotiation.history(recent_first, limit, before, after, before_id, after_id)
     except AttributeError:
         return None
 
 
 def negotiation_options(self, user):
+    if getattr(self, '_negotiation_status_user', _NOT_ATTACHED) == user.pk:
+        return self.negotiation_transitions
     try:
-        return self.negotiation.get_allowed_transitions(user)
+        return self.negotiation.allowed_transitions(user)
     except AttributeError:
         return []
 
 
+# methods and properties added to the negotiable classes, measured by the instrumentation (but for the lazy history())
+NEGOTIABLE_METHODS = [
+    'negotiation', 'negotiate', 'status_for', 'accept', 'cancel', 'counter_proposal', 'modify_proposal',
+    'is_negotiating', 'is_accepted', 'is_cancelled', 'is_seller', 'is_client', 'last_proposal_from',
+    'last_counterpart_proposal_for', 'last_client_proposal', 'last_seller_proposal', 'initiator', 'last_updater',
+    'is_last_updater', 'negotiation_options',
+]
+
+
 def negotiable(cls):
     # EXTEND NEGOTIABLE CLASS
 
@@ -238,6 +508,10 @@ def negotiable(cls):
     negotiations = GenericRelation(Negotiation, object_id_field='content_pk', content_type_field='content_type')
     negotiations.contribute_to_class(cls, 'negotiations')
 
+    # add the generic relation to the archived negotiations
+    archives = GenericRelation(NegotiationArchive, object_id_field='content_pk', content_type_field='content_type')
+    archives.contribute_to_class(cls, 'negotiation_archives')
+
     # add the negotiation property
     setattr(cls, 'negotiation', negotiation)
 
@@ -301,6 +575,9 @@ def negotiable(cls):
     # add the negotiation_options method
     setattr(cls, 'negotiation_options', negotiation_options)
 
+    # measure them when the instrumentation is enabled
+    instrument(cls, 'negotiable.%s.%s' % (cls._meta.app_label, cls._meta.model_name), NEGOTIABLE_METHODS)
+
     # EXTEND NEGOTIABLE CLASS'S MANAGERS AND QUERYSETS
 
     cls._meta.concrete_managers.sort()
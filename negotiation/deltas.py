@@ -0,0 +1,56 @@
+# coding=utf-8
+"""
+JSON-patch-like deltas between two frozen contents, used to store most proposals as the changes from the previous one
+(see NEGOTIATION_SNAPSHOT_INTERVAL). A delta is a list of operations: ['add', path, value], ['replace', path, value]
+or ['remove', path], where path is the list of keys leading to the changed value. Nested dicts are diffed key by key,
+any other value (lists included) is replaced as a whole.
+"""
+
+
+def diff(old, new, path=()):
+    """
+    Returns the delta that turns 'old' into 'new'.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return [] if old == new else [['replace', list(path), new]]
+    operations = [['remove', list(path) + [key]] for key in old if key not in new]
+    for key, value in new.items():
+        if key not in old:
+            operations.append(['add', list(path) + [key], value])
+        elif old[key] != value:
+            if isinstance(old[key], dict) and isinstance(value, dict):
+                operations.extend(diff(old[key], value, tuple(path) + (key,)))
+            else:
+                operations.append(['replace', list(path) + [key], value])
+    return operations
+
+
+def patch(content, delta):
+    """
+    Returns the result of applying 'delta' to 'content'. 'content' is not modified: the changed dicts are copied, and
+    the unchanged nested values are shared with it.
+    """
+    copied = set()
+
+    def copy(value):
+        value = dict(value)
+        copied.add(id(value))
+        return value
+
+    for operation in delta:
+        path = operation[1]
+        if not path:
+            content = operation[2]
+            continue
+        if id(content) not in copied:
+            content = copy(content)
+        target = content
+        for key in path[:-1]:
+            if id(target[key]) not in copied:
+                target[key] = copy(target[key])
+            target = target[key]
+        if operation[0] == 'remove':
+            del target[path[-1]]
+        else:
+            target[path[-1]] = operation[2]
+    return content
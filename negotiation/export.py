@@ -0,0 +1,55 @@
+# coding=utf-8
+"""
+Streaming export of the negotiations and their decoded histories as JSON lines (one negotiation per line). The
+negotiations are read in keyset-paginated chunks, with the proposals of each chunk read in one query and grouped by
+negotiation (see history_records()), so memory usage does not depend on the size of the tables.
+"""
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from models import Negotiation, history_records
+
+HISTORY_KEYS = ('updater', 'role', 'transition', 'updated', 'notes', 'content')
+
+
+def iter_negotiations(since=None, chunk_size=500):
+    """
+    Yields a dict for each negotiation (updated after 'since', if given), with its history in chronological order.
+    """
+    negotiations = Negotiation.objects.select_related('current_state', 'content_type').order_by('pk')
+    if since is not None:
+        negotiations = negotiations.filter(updated__gt=since)
+    last_pk = 0
+    while True:
+        chunk = list(negotiations.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return
+        histories = history_records(chunk)
+        for negotiation in chunk:
+            yield {
+                'id': negotiation.pk,
+                'content_type': '%s.%s' % (negotiation.content_type.app_label, negotiation.content_type.model),
+                'content_pk': negotiation.content_pk,
+                'state': negotiation.current_state.name if negotiation.current_state else None,
+                'starter': negotiation.starter_id,
+                'client': negotiation.client_id,
+                'seller': negotiation.seller_id,
+                'rounds': negotiation.rounds,
+                'updated': negotiation.updated,
+                'history': [dict(zip(HISTORY_KEYS, record)) for record in histories[negotiation.pk]],
+            }
+        last_pk = chunk[-1].pk
+
+
+def export_negotiations(output, since=None, chunk_size=500):
+    """
+    Writes the negotiations updated after 'since' (all of them if None) to the binary file-like 'output', as UTF-8
+    JSON lines. Returns the number of negotiations written and the watermark to pass as 'since' to the next
+    incremental export (the latest 'updated' written, or 'since' when nothing was written).
+    """
+    count, watermark = 0, since
+    for record in iter_negotiations(since, chunk_size):
+        output.write((json.dumps(record, cls=DjangoJSONEncoder, sort_keys=True) + '\n').encode('utf-8'))
+        count += 1
+        if watermark is None or record['updated'] > watermark:
+            watermark = record['updated']
+    return count, watermark
@@ -0,0 +1,171 @@
+# coding=utf-8
+"""
+Opt-in instrumentation of the negotiation operations: the time and number of queries of each public method of the
+negotiations, of the negotiable models and of the template tags, and the hits and misses of the constants cache, are
+sent to the sink set by NEGOTIATION_INSTRUMENTATION. When it is not set, instrumented operations only pay for checking
+a module global.
+"""
+import logging
+import socket
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+from django.conf import settings as django_settings
+from django.db import connection
+from django.utils.module_loading import import_by_path
+from settings import NEGOTIATION_INSTRUMENTATION, NEGOTIATION_STATSD_ADDRESS, NEGOTIATION_STATSD_PREFIX
+
+logger = logging.getLogger(__name__)
+
+
+class LoggingSink(object):
+    """
+    Logs every measure (with the INFO level) to the 'negotiation.instrumentation' logger.
+    """
+
+    def timing(self, name, seconds, queries):
+        logger.info("%s: %.3fms, %d queries", name, seconds * 1000, queries)
+
+    def count(self, name, value=1):
+        logger.info("%s: %+d", name, value)
+
+
+class MemorySink(object):
+    """
+    Keeps the measures in memory, to inspect them in tests.
+    """
+
+    def __init__(self):
+        self.timings = []
+        self.counts = {}
+
+    def timing(self, name, seconds, queries):
+        self.timings.append((name, seconds, queries))
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def names(self):
+        return [name for name, seconds, queries in self.timings]
+
+    def clear(self):
+        self.timings = []
+        self.counts = {}
+
+
+class StatsdSink(object):
+    """
+    Sends the measures to a statsd server over UDP (NEGOTIATION_STATSD_ADDRESS): the times as timers, and the queries
+    and cache hits and misses as counters. Sending errors are ignored, as UDP does not guarantee delivery anyway.
+    """
+
+    def __init__(self, address=NEGOTIATION_STATSD_ADDRESS, prefix=NEGOTIATION_STATSD_PREFIX):
+        self.address = tuple(address)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data.encode('utf-8'), self.address)
+        except (socket.error, UnicodeError):
+            pass
+
+    def timing(self, name, seconds, queries):
+        self.send("%s.%s:%.3f|ms\n%s.%s.queries:%d|c" % (
+            self.prefix, name, seconds * 1000, self.prefix, name, queries
+        ))
+
+    def count(self, name, value=1):
+        self.send("%s.%s:%d|c" % (self.prefix, name, value))
+
+
+SINKS = {
+    'logging': LoggingSink,
+    'memory': MemorySink,
+    'statsd': StatsdSink,
+}
+
+_sink = None
+
+
+def configure(sink):
+    """
+    Sets the sink receiving the measures, and returns it: None (disables the instrumentation), one of 'logging',
+    'memory' or 'statsd', the dotted path of a sink class, or a sink instance (an object with timing(name, seconds,
+    queries) and count(name, value) methods).
+    """
+    global _sink
+    if sink in SINKS:
+        sink = SINKS[sink]()
+    elif isinstance(sink, basestring):
+        sink = import_by_path(sink)()
+    _sink = sink
+    return sink
+
+
+def get_sink():
+    return _sink
+
+
+def _logs_queries(use_debug_cursor):
+    return use_debug_cursor or (use_debug_cursor is None and django_settings.DEBUG)
+
+
+@contextmanager
+def measure(name):
+    """
+    Sends the time and number of queries (on the default database) of the enclosed block to the sink as 'name'.
+    """
+    sink = _sink
+    if sink is None:
+        yield
+        return
+    # count the queries through the debug cursor, forgetting them afterwards unless they were being logged anyway
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    first_query = len(connection.queries)
+    start = default_timer()
+    try:
+        yield
+    finally:
+        seconds = default_timer() - start
+        queries = len(connection.queries) - first_query
+        connection.use_debug_cursor = use_debug_cursor
+        if not _logs_queries(use_debug_cursor):
+            del connection.queries[first_query:]
+        sink.timing(name, seconds, queries)
+
+
+def count(name, value=1):
+    """
+    Sends a counter increment to the sink.
+    """
+    if _sink is not None:
+        _sink.count(name, value)
+
+
+def instrumented(name, function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if _sink is None:
+            return function(*args, **kwargs)
+        with measure(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def instrument(cls, prefix, names):
+    """
+    Wraps the methods and properties 'names' of 'cls' so they are measured as '<prefix>.<name>'.
+    """
+    for name in names:
+        attribute = cls.__dict__[name]
+        if isinstance(attribute, property):
+            attribute = property(instrumented('%s.%s' % (prefix, name), attribute.fget), attribute.fset,
+                                 attribute.fdel, attribute.__doc__)
+        else:
+            attribute = instrumented('%s.%s' % (prefix, name), attribute)
+        setattr(cls, name, attribute)
+
+
+configure(NEGOTIATION_INSTRUMENTATION)
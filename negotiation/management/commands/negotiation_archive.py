@@ -0,0 +1,32 @@
+# coding=utf-8
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from negotiation.archive import archivable, archive_negotiations
+
+
+class Command(BaseCommand):
+    help = ("Moves the closed (accepted or cancelled) negotiations not updated for some days to the archive table, "
+            "deleting their proposals, workflow history, local roles and object permissions.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=90,
+                    help='Archive the negotiations closed and not updated for this number of days.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help='Number of negotiations archived per transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only count the negotiations to archive, without archiving them.'),
+    )
+
+    def handle(self, *args, **options):
+        negotiations = archivable(options['days']).select_related('current_state').order_by('pk')
+        if options['dry_run']:
+            self.stdout.write("%d negotiations to archive." % negotiations.count())
+            return
+        count, last_pk = 0, 0
+        while True:
+            batch = list(negotiations.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            count += archive_negotiations(batch)
+            last_pk = batch[-1].pk
+        self.stdout.write("%d negotiations archived." % count)
@@ -0,0 +1,40 @@
+# coding=utf-8
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from negotiation.models import Negotiation, refresh_inboxes
+
+
+class Command(BaseCommand):
+    help = ("Copies the history of the negotiations created before the proposals table was introduced from the "
+            "workflow history, and populates their summary fields and inboxes.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Rebuild the proposals and summary of every negotiation, not only the missing ones.'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help='Number of negotiations migrated per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        negotiations = Negotiation.objects.select_related('client', 'current_state').order_by('pk')
+        if not options['all']:
+            negotiations = negotiations.filter(rounds=0)
+        count, last_pk = 0, 0
+        while True:
+            # keyset pagination keeps memory usage constant, whatever the size of the table
+            chunk = list(negotiations.filter(pk__gt=last_pk)[:options['chunk_size']])
+            if not chunk:
+                break
+            with transaction.atomic():
+                for negotiation in chunk:
+                    self.backfill(negotiation)
+                refresh_inboxes([negotiation.pk for negotiation in chunk])
+            count += len(chunk)
+            last_pk = chunk[-1].pk
+        self.stdout.write("%d negotiations updated." % count)
+
+    def backfill(self, negotiation):
+        fields = negotiation.backfill_summary()
+        if fields is not None:
+            Negotiation.objects.filter(pk=negotiation.pk).update(**fields)
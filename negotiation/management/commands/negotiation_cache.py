@@ -0,0 +1,21 @@
+# coding=utf-8
+from django.core.management.base import BaseCommand, CommandError
+from negotiation import caching
+import negotiation.models  # registers the cached constants
+
+
+class Command(BaseCommand):
+    args = '<warm|flush>'
+    help = "Warms up or flushes the cached negotiation roles, permissions, workflow and transitions."
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in ('warm', 'flush'):
+            raise CommandError("Usage: negotiation_cache %s" % self.args)
+        if args[0] == 'flush':
+            caching.flush()
+            self.stdout.write("Negotiation cache flushed.")
+            return
+        missing = caching.warm()
+        if missing:
+            raise CommandError("Could not load: %s" % ', '.join(missing))
+        self.stdout.write("Negotiation cache warmed up.")
@@ -0,0 +1,58 @@
+# coding=utf-8
+import gzip
+import sys
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from negotiation.export import export_negotiations
+
+
+class Command(BaseCommand):
+    help = ("Exports the negotiations with their decoded histories as JSON lines, one negotiation per line (gzip "
+            "compressed with --gzip or when the output file name ends with .gz).")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default='-',
+                    help='File to write the export to ("-", the default, for the standard output).'),
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+                    help='Compress the export with gzip.'),
+        make_option('--since', dest='since', default=None,
+                    help='Only export the negotiations updated after this ISO 8601 date and time (e.g. the watermark '
+                         'reported by the previous export).'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help='Number of negotiations read per query.'),
+    )
+
+    def parse_since(self, value):
+        try:
+            since = parse_datetime(value)
+        except ValueError:
+            since = None
+        if since is None:
+            raise CommandError("Invalid --since date and time: %s" % value)
+        if settings.USE_TZ and timezone.is_naive(since):
+            since = timezone.make_aware(since, timezone.get_default_timezone())
+        return since
+
+    def handle(self, *args, **options):
+        since = self.parse_since(options['since']) if options['since'] else None
+        if options['output'] == '-':
+            stream = getattr(sys.stdout, 'buffer', sys.stdout)
+        else:
+            stream = open(options['output'], 'wb')
+        output = stream
+        if options['gzip'] or options['output'].endswith('.gz'):
+            output = gzip.GzipFile(fileobj=stream, mode='wb')
+        try:
+            count, watermark = export_negotiations(output, since, options['chunk_size'])
+        finally:
+            if output is not stream:
+                output.close()  # does not close the underlying stream
+            if options['output'] != '-':
+                stream.close()
+        # the standard output may be carrying the export itself
+        self.stderr.write("%d negotiations exported. Watermark: %s" % (
+            count, watermark.isoformat() if watermark is not None else '-'
+        ))
@@ -0,0 +1,47 @@
+# coding=utf-8
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from negotiation.models import NegotiationPart
+
+
+class Command(BaseCommand):
+    help = ("Deletes the groups automatically created for single users as negotiation parts, that are no longer "
+            "referenced by any negotiation (archived or not).")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of groups deleted per transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only count the orphaned groups, without deleting them.'),
+    )
+
+    def orphaned_groups(self):
+        # only the groups recorded as created for a single user, still holding that user alone
+        return NegotiationPart.objects.filter(
+            negotiation_auto_group__isnull=False,
+            as_client__isnull=True, as_seller__isnull=True,
+            archived_as_client__isnull=True, archived_as_seller__isnull=True
+        ).annotate(members=Count('user')).filter(members=1)
+
+    def handle(self, *args, **options):
+        groups = self.orphaned_groups().order_by('pk')
+        count, last_pk = 0, 0
+        while True:
+            batch = list(groups.filter(pk__gt=last_pk).values_list('pk', flat=True)[:options['batch_size']])
+            if not batch:
+                break
+            found = batch
+            if not options['dry_run']:
+                with transaction.atomic():
+                    # lock the candidates and check them again: a negotiation may have started with one of them
+                    # (reusing a canonical group) since they were listed, and deleting it would cascade to it
+                    locked = list(NegotiationPart.objects.select_for_update().filter(
+                        pk__in=batch
+                    ).values_list('pk', flat=True))
+                    found = list(self.orphaned_groups().filter(pk__in=locked).values_list('pk', flat=True))
+                    NegotiationPart.objects.filter(pk__in=found).delete()
+            count += len(found)
+            last_pk = batch[-1]
+        self.stdout.write("%d orphaned groups %s." % (count, "found" if options['dry_run'] else "deleted"))
@@ -0,0 +1,36 @@
+# coding=utf-8
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from negotiation.models import Negotiation
+from negotiation import settings
+
+
+class Command(BaseCommand):
+    help = ("Grants both parts of the existing negotiations the object permissions needed by the turn-based mode "
+            "(NEGOTIATION_TURN_BASED). Negotiations not backfilled yet (see negotiation_backfill) are skipped.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                    help='Number of negotiations updated per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        if not settings.NEGOTIATION_TURN_BASED:
+            raise CommandError("NEGOTIATION_TURN_BASED is not enabled.")
+        # the turn of a negotiation is read from its summary, so the ones without it keep their per-part permissions
+        skipped = Negotiation.objects.filter(rounds=0).count()
+        negotiations = Negotiation.objects.filter(rounds__gt=0).order_by('pk')
+        count, last_pk = 0, 0
+        while True:
+            chunk = list(negotiations.filter(pk__gt=last_pk)[:options['chunk_size']])
+            if not chunk:
+                break
+            with transaction.atomic():
+                for negotiation in chunk:
+                    negotiation.init_permissions()
+            count += len(chunk)
+            last_pk = chunk[-1].pk
+        self.stdout.write("%d negotiations updated." % count)
+        if skipped:
+            self.stdout.write("%d negotiations skipped: run negotiation_backfill first." % skipped)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'NegotiationProposal'
+        db.create_table(u'negotiation_negotiationproposal', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('negotiation', self.gf('django.db.models.fields.related.ForeignKey')(related_name='proposals', to=orm['negotiation.Negotiation'])),
+            ('actor', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['auth.User'])),
+            ('role', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['permissions.Role'])),
+            ('transition', self.gf('django.db.models.fields.CharField')(max_length=100)),
+            ('created', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now)),
+            ('notes', self.gf('django.db.models.fields.TextField')(max_length=1000, null=True)),
+            ('content', self.gf('django.db.models.fields.TextField')()),
+        ))
+        db.send_create_signal(u'negotiation', ['NegotiationProposal'])
+
+        # Adding index on 'NegotiationProposal', fields ['negotiation', 'role', 'created']
+        db.create_index(u'negotiation_negotiationproposal', ['negotiation_id', 'role_id', 'created'])
+
+        # Deleting field 'Negotiation.latest_client_version'
+        db.delete_column(u'negotiation_negotiation', 'latest_client_version_id')
+
+        # Deleting field 'Negotiation.latest_seller_version'
+        db.delete_column(u'negotiation_negotiation', 'latest_seller_version_id')
+
+        # Adding field 'Negotiation.latest_client_proposal'
+        db.add_column(u'negotiation_negotiation', 'latest_client_proposal',
+                      self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='+', null=True, to=orm['negotiation.NegotiationProposal']),
+                      keep_default=False)
+
+        # Adding field 'Negotiation.latest_seller_proposal'
+        db.add_column(u'negotiation_negotiation', 'latest_seller_proposal',
+                      self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='+', null=True, to=orm['negotiation.NegotiationProposal']),
+                      keep_default=False)
+
+        # Existing negotiations have no proposals yet: mark them as not backfilled (see the negotiation_backfill command)
+        db.execute("UPDATE negotiation_negotiation SET rounds = 0")
+
+
+    def backwards(self, orm):
+        # Deleting field 'Negotiation.latest_client_proposal'
+        db.delete_column(u'negotiation_negotiation', 'latest_client_proposal_id')
+
+        # Deleting field 'Negotiation.latest_seller_proposal'
+        db.delete_column(u'negotiation_negotiation', 'latest_seller_proposal_id')
+
+        # Adding field 'Negotiation.latest_client_version'
+        db.add_column(u'negotiation_negotiation', 'latest_client_version',
+                      self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='+', null=True, to=orm['workflows.WorkflowHistorical']),
+                      keep_default=False)
+
+        # Adding field 'Negotiation.latest_seller_version'
+        db.add_column(u'negotiation_negotiation', 'latest_seller_version',
+                      self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='+', null=True, to=orm['workflows.WorkflowHistorical']),
+                      keep_default=False)
+
+        # Removing index on 'NegotiationProposal', fields ['negotiation', 'role', 'created']
+        db.delete_index(u'negotiation_negotiationproposal', ['negotiation_id', 'role_id', 'created'])
+
+        # Deleting model 'NegotiationProposal'
+        db.delete_table(u'negotiation_negotiationproposal')
+
+        db.execute("UPDATE negotiation_negotiation SET rounds = 0")
+
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Group']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Permission']"}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'negotiation.negotiation': {
+            'Meta': {'ordering': "('current_state',)", 'unique_together': "(('content_type', 'content_pk'),)", 'object_name': 'Negotiation'},
+            'client': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'as_client'", 'to': u"orm['auth.Group']"}),
+            'content_pk': ('django.db.models.fields.IntegerField', [], {}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'negotiations'", 'to': u"orm['contenttypes.ContentType']"}),
+            'current_state': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['workflows.State']", 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_transition_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'last_updater_role': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'to': u"orm['permissions.Role']"}),
+            'last_updater_user': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'to': u"orm['auth.User']"}),
+            'latest_client_proposal': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'to': u"orm['negotiation.NegotiationProposal']"}),
+            'latest_seller_proposal': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'+'", 'null': 'True', 'to': u"orm['negotiation.NegotiationProposal']"}),
+            'notes': ('django.db.models.fields.TextField', [], {'max_length': '1000', 'null': 'True'}),
+            'rounds': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'seller': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'as_seller'", 'to': u"orm['auth.Group']"}),
+            'starter': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        u'negotiation.negotiationproposal': {
+            'Meta': {'object_name': 'NegotiationProposal', 'index_together': "(('negotiation', 'role', 'created'),)"},
+            'actor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': u"orm['auth.User']"}),
+            'content': ('django.db.models.fields.TextField', [], {}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'negotiation': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'proposals'", 'to': u"orm['negotiation.Negotiation']"}),
+            'notes': ('django.db.models.fields.TextField', [], {'max_length': '1000', 'null': 'True'}),
+            'role': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': u"orm['permissions.Role']"}),
+            'transition': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'permissions.permission': {
+            'Meta': {'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '100'}),
+            'content_types': ('django.db.models.fields.related.ManyToManyField', [], {'blank': 'True', 'related_name': "'content_types'", 'null': 'True', 'symmetrical': 'False', 'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '100'})
+        },
+        u'permissions.role': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'Role'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '100'})
+        },
+        u'workflows.state': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'State'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'transitions': ('django.db.models.fields.related.ManyToManyField', [], {'blank': 'True', 'related_name': "'states'", 'null': 'True', 'symmetrical': 'False', 'to': u"orm['workflows.Transition']"}),
+            'workflow': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'states'", 'to': u"orm['workflows.Workflow']"})
+        },
+        u'workflows.transition': {
+            'Meta': {'object_name': 'Transition'},
+            'condition': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'destination': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'destination_state'", 'null': 'True', 'to': u"orm['workflows.State']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'permission': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['permissions.Permission']", 'null': 'True', 'blank': 'True'}),
+            'workflow': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'transitions'", 'to': u"orm['workflows.Workflow']"})
+        },
+        u'workflows.workflow': {
+            'Meta': {'object_name': 'Workflow'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'initial_state': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'workflow_state'", 'null': 'True', 'to': u"orm['workflows.State']"}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '100'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['permissions.Permission']", 'through': u"orm['workflows.WorkflowPermissionRelation']", 'symmetrical': 'False'})
+        },
+        u'workflows.workflowhistorical': {
+            'Meta': {'object_name': 'WorkflowHistorical'},
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'content_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'state': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['workflows.State']", 'null': 'True', 'blank': 'True'}),
+            'update_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']", 'null': 'True', 'blank': 'True'})
+        },
+        u'workflows.workflowpermissionrelation': {
+            'Meta': {'unique_together': "(('workflow', 'permission'),)", 'object_name': 'WorkflowPermissionRelation'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'permission': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'permissions'", 'to': u"orm['permissions.Permission']"}),
+            'workflow': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['workflows.Workflow']"})
+        }
+    }
+
+    complete_apps = ['negotiation']
\ No newline at end of file
@@ -1,80 +1,457 @@
 # coding=utf-8
 import json
 import logging
+import zlib
+from itertools import groupby
+from operator import attrgetter
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
 from django.contrib.auth.models import User, Group
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from permissions.models import Role, Permission
 from permissions.utils import grant_permission, remove_permission, get_local_roles
 from workflows.decorators import workflow_enabled
-from workflows.models import WorkflowHistorical
+from workflows.models import Transition, Workflow, WorkflowHistorical
+from deltas import diff, patch
+import serializers
+from caching import cached_constant, bump_members_version, cached_pending_count, forget_pending_counts
+from instrumentation import instrument
+import settings
+from settings import WORKFLOWS, NEGOTIATION_USER_GROUP_NAME, NEGOTIATION_PROFILE_MODEL
 
 logger = logging.getLogger(__name__)
 
 
+@cached_constant('NEGOTIATION_COUNTERPART_PERMISSION')
 def counterpart_permission():
-    counterpart = cache.get('NEGOTIATION_COUNTERPART_PERMISSION')
-    if counterpart is not None:
-        return counterpart
     try:
-        counterpart = Permission.objects.get(codename="COUNTERPART")
-        cache.set('NEGOTIATION_COUNTERPART_PERMISSION', counterpart)
-        return counterpart
+        return Permission.objects.get(codename="COUNTERPART")
     except ObjectDoesNotExist as e:
         logger.exception(e)
 
 
+@cached_constant('NEGOTIATION_LAST_UPDATER_PERMISSION')
 def last_updater_permission():
-    last_updater = cache.get('NEGOTIATION_LAST_UPDATER_PERMISSION')
-    if last_updater is not None:
-        return last_updater
     try:
-        last_updater = Permission.objects.get(codename="LAST_UPDATER")
-        cache.set('NEGOTIATION_LAST_UPDATER_PERMISSION', last_updater)
-        return last_updater
+        return Permission.objects.get(codename="LAST_UPDATER")
     except ObjectDoesNotExist as e:
         logger.exception(e)
 
 
+@cached_constant('NEGOTIATION_CLIENT_ROLE')
 def client_role():
-    client = cache.get('NEGOTIATION_CLIENT_ROLE')
-    if client is not None:
-        return client
     try:
-        client = Role.objects.get(name="Client")
-        cache.set('NEGOTIATION_CLIENT_ROLE', client)
-        return client
+        return Role.objects.get(name="Client")
     except ObjectDoesNotExist as e:
         logger.exception(e)
 
 
+@cached_constant('NEGOTIATION_SELLER_ROLE')
 def seller_role():
-    seller = cache.get('NEGOTIATION_SELLER_ROLE')
-    if seller is not None:
-        return seller
     try:
-        seller = Role.objects.get(name="Seller")
-        cache.set('NEGOTIATION_SELLER_ROLE', seller)
-        return seller
+        return Role.objects.get(name="Seller")
     except ObjectDoesNotExist as e:
         logger.exception(e)
 
 
+@cached_constant('NEGOTIATION_WORKFLOW')
+def negotiation_workflow():
+    try:
+        return Workflow.objects.get(name=WORKFLOWS['negotiation.models.Negotiation']['name'])
+    except ObjectDoesNotExist as e:
+        logger.exception(e)
+
+
+@cached_constant('NEGOTIATION_TRANSITIONS')
+def negotiation_transitions():
+    """
+    Returns the transitions of the negotiation workflow, as a {name: transition} dict.
+    """
+    transitions = Transition.objects.filter(workflow__name=WORKFLOWS['negotiation.models.Negotiation']['name'])
+    return dict((transition.name, transition) for transition in transitions.select_related('permission')) or None
+
+
+# Maximum number of queries issued by each transition of a backfilled negotiation loaded through its negotiable,
+# besides the ones of the workflow engine's do_<transition>: the parts and their membership checks (4), the proposal
+# insert and, in delta mode, the previous content (2), the inbox refresh of the transitions that pass the turn (3),
+# the permission swap of a counter-proposal (8), and the savepoint of a transaction nested in another one (2)
+TRANSITION_QUERY_BUDGET = {
+    'Accept': 11,
+    'Cancel': 11,
+    'Negotiate': 19,
+    'Modify': 8,
+}
+
+# Columns written by the workflow transition's save during a transition (see Negotiation._do_update)
+TRANSITION_UPDATE_FIELDS = frozenset([
+    'current_state', 'state_code', 'notes', 'updated', 'version', 'last_updater_user', 'last_updater_role', 'rounds',
+    'last_transition_at', 'latest_client_proposal', 'latest_seller_proposal',
+])
+
+
+class TransitionNotAllowed(Exception):
+    pass
+
+
+class StaleNegotiation(Exception):
+    """
+    Raised when a transition is attempted on a negotiation that was changed by someone else since it was loaded.
+    """
+    pass
+
+
+_UNDECODED = object()
+
+
+class HistoryItem(object):
+    """
+    An item of a negotiation history. Its JSON payload is only decoded when 'content' or 'notes' are read, so
+    metadata-only uses ('updater', 'updated') never pay for parsing it. Items can also be read like the dicts history()
+    used to return (item['content']). 'pk' identifies the item within its history, to page through it.
+    """
+    __slots__ = ('updater', 'updated', 'transition', 'pk', '_payload', '_content', '_notes')
+
+    keys = ('content', 'notes', 'updater', 'updated')
+
+    def __init__(self, updater, updated, payload, notes=_UNDECODED, transition=None, content=_UNDECODED, pk=None):
+        # without notes, the payload is a {'content': ..., 'notes': ...} dict, as stored in the workflow history
+        self.updater = updater
+        self.updated = updated
+        self.pk = pk
+        self.transition = transition
+        self._payload = payload
+        self._content = content
+        self._notes = notes
+
+    def _decode(self):
+        data = serializers.loads(self._payload)
+        if self._notes is _UNDECODED:
+            self._content, self._notes = data.get('content'), data.get('notes')
+        else:
+            self._content = data
+        self._payload = None
+
+    @property
+    def content(self):
+        if self._content is _UNDECODED:
+            self._decode()
+        return self._content
+
+    @property
+    def notes(self):
+        if self._notes is _UNDECODED:
+            self._decode()
+        return self._notes
+
+    def __getitem__(self, key):
+        if key not in self.keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.keys else default
+
+
+def _keyset(items, field, before, before_id, after, after_id):
+    # filters 'items' on ('field', id) keys, the ids breaking the ties between the items sharing a timestamp
+    if before is not None:
+        condition = models.Q(**{field + '__lt': before})
+        if before_id is not None:
+            condition |= models.Q(**{field: before, 'id__lt': before_id})
+        items = items.filter(condition)
+    if after is not None:
+        condition = models.Q(**{field + '__gt': after})
+        if after_id is not None:
+            condition |= models.Q(**{field: after, 'id__gt': after_id})
+        items = items.filter(condition)
+    return items
+
+
+# name recorded for the proposal that starts a negotiation, which is not made through a workflow transition
+START_TRANSITION = 'Start'
+
+# transitions recorded for the last proposal of a history rebuilt from the workflow history, by closing state
+CLOSING_TRANSITIONS = {
+    'Accepted': 'Accept',
+    'Cancelled': 'Cancel',
+}
+
+
+def rebuild_contents(proposals, base=None):
+    """
+    Yields a (proposal, content) tuple for each one of the passed consecutive proposals of a negotiation (in the order
+    they were made), applying the delta proposals to the content of the previous one ('base' for the first one).
+    """
+    content = base
+    for proposal in proposals:
+        data = serializers.loads(proposal.content)
+        content = patch(content, data) if proposal.is_delta else data
+        yield proposal, content
+
+
+def history_records(negotiations):
+    """
+    Returns a {negotiation pk: history} dict with the whole history of each one of the passed negotiations, as a list
+    of (updater pk, role ('client' or 'seller'), transition, updated, notes, content) tuples in chronological order.
+    The proposals are read with a single query, plus one query for each negotiation not backfilled yet, whose history
+    is read from the workflow history (without roles nor transitions).
+    """
+    negotiations = list(negotiations)
+    proposals = NegotiationProposal.objects.filter(
+        negotiation__in=[negotiation.pk for negotiation in negotiations]
+    ).order_by('negotiation', 'created', 'id')
+    proposals_by_negotiation = dict(
+        (negotiation_id, list(group))
+        for negotiation_id, group in groupby(proposals.iterator(), attrgetter('negotiation_id'))
+    )
+    client_role_id = client_role().pk
+    records = {}
+    for negotiation in negotiations:
+        if not negotiation.has_summary:
+            # not backfilled yet (see the negotiation_backfill command): read it from the workflow history
+            records[negotiation.pk] = [
+                (item.updater.pk, None, None, item.updated, item.notes, item.content)
+                for item in negotiation.history(recent_first=False)
+            ]
+            continue
+        records[negotiation.pk] = [
+            (proposal.actor_id, 'client' if proposal.role_id == client_role_id else 'seller', proposal.transition,
+             proposal.created, proposal.notes, content)
+            for proposal, content in rebuild_contents(proposals_by_negotiation.get(negotiation.pk, []))
+        ]
+    return records
+
+
+STATUSES = {
+    'LAST_UPDATER': (_(u'WAITING FOR COUNTERPART'), 'waiting'),
+    'COUNTERPART': (_(u'PENDING ACTION'), 'pending'),
+    'ACCEPTED': (_(u'ACCEPTED'), 'accepted'),
+    'CANCELLED': (_(u'CANCELLED'), 'cancelled'),
+}
+
+
+# Codes of the states, stored in the indexed Negotiation.state_code column (kept in sync with current_state by the
+# transitions), so negotiations can be filtered and counted by state without joining the workflow states
+NEGOTIATING, ACCEPTED, CANCELLED = 1, 2, 3
+STATE_CODES = {
+    'Negotiating': NEGOTIATING,
+    'Accepted': ACCEPTED,
+    'Cancelled': CANCELLED,
+}
+STATE_NAMES = dict((code, name) for name, code in STATE_CODES.items())
+TRANSITION_DESTINATIONS = dict(
+    (transition['name'], transition['destination'])
+    for transition in WORKFLOWS['negotiation.models.Negotiation']['transitions']
+)
+
+
+def _transition_matrix(workflow):
+    """
+    Returns the names of the transitions allowed by 'workflow' as a {(state, turn, side): names} dict, where 'turn' is
+    the part expected to act next and 'side' the part(s) the user belongs to ('client', 'seller', 'both' or None). The
+    part whose turn it is holds the COUNTERPART permission, and the other one the LAST_UPDATER permission.
+    """
+    permissions = dict((transition['name'], transition.get('permission')) for transition in workflow['transitions'])
+    sides = {None: (), 'client': ('client',), 'seller': ('seller',), 'both': ('client', 'seller')}
+    matrix = {}
+    for state, names in workflow['state_transitions'].items():
+        for turn in ('client', 'seller'):
+            for side, parts in sides.items():
+                codenames = set('COUNTERPART' if part == turn else 'LAST_UPDATER' for part in parts)
+                matrix[(state, turn, side)] = tuple(
+                    name for name in names if permissions[name] is None or permissions[name] in codenames
+                )
+    return matrix
+
+
+# Transitions allowed to each side of a negotiation, by state and turn (states without transitions are left out)
+TRANSITION_MATRIX = _transition_matrix(WORKFLOWS['negotiation.models.Negotiation'])
+
+
 class NegotiationManager(models.Manager):
 
+    def for_user(self, user, model=None, role=None):
+        """
+        Returns the negotiations where 'user' is a member of one of the parts, with a single query. 'model' restricts
+        them to the negotiations of a negotiable model, and 'role' ('client' or 'seller') to the ones where the user is
+        a member of that part.
+        """
+        if role not in (None, 'client', 'seller'):
+            raise ValueError("Unknown negotiation role: %r." % role)
+        user_groups = User.groups.through.objects.filter(user=user.pk).values('group_id')
+        negotiations = self.get_queryset()
+        if model is not None:
+            negotiations = negotiations.filter(content_type=ContentType.objects.get_for_model(model))
+        if role == 'client':
+            return negotiations.filter(client__in=user_groups)
+        if role == 'seller':
+            return negotiations.filter(seller__in=user_groups)
+        return negotiations.filter(models.Q(client__in=user_groups) | models.Q(seller__in=user_groups))
+
     def client_for_model(self, user, model):
-        ctype = ContentType.objects.get_for_model(model)
-        negotiation_parts_ids = NegotiationPart.objects.filter(pk__in=user.groups.all())
-        return self.get_queryset().filter(content_type=ctype).filter(client__in=negotiation_parts_ids)
+        return self.for_user(user, model, 'client')
 
     def seller_for_model(self, user, model):
+        return self.for_user(user, model, 'seller')
+
+    def pending_for(self, user):
+        """
+        Returns the negotiations waiting for an action of 'user' (read from the inbox).
+        """
+        return self.get_queryset().filter(inbox__user=user.pk)
+
+    def pending_count_for(self, user):
+        """
+        Returns the number of negotiations waiting for an action of 'user', usually from the cache.
+        """
+        return cached_pending_count(user.pk, lambda: NegotiationInbox.objects.filter(user=user.pk).count())
+
+    def statuses_for(self, user, negotiables):
+        """
+        Returns a {negotiable pk: (status, allowed transitions)} dict with the status and the negotiation options of
+        'user' for each one of the passed negotiables (a queryset or a list of instances of a negotiable model), using
+        a fixed number of queries. Archived negotiations are included, and negotiables without negotiation are left out
+        of the result.
+        """
+        if isinstance(negotiables, models.query.QuerySet):
+            model, pks = negotiables.model, negotiables.values('pk')
+        else:
+            negotiables = list(negotiables)
+            if not negotiables:
+                return {}
+            model, pks = negotiables[0].__class__, [negotiable.pk for negotiable in negotiables]
         ctype = ContentType.objects.get_for_model(model)
-        negotiation_parts_ids = NegotiationPart.objects.filter(pk__in=user.groups.all())
-        return self.get_queryset().filter(content_type=ctype).filter(seller__in=negotiation_parts_ids)
+        negotiations = list(
+            self.get_queryset().filter(content_type=ctype, content_pk__in=pks).select_related('current_state')
+        )
+        statuses = self.statuses(user, negotiations)
+        statuses = dict((negotiation.content_pk, statuses[negotiation.pk]) for negotiation in negotiations)
+        if not isinstance(pks, list) or len(statuses) < len(pks):  # some negotiables may have been archived
+            archives = NegotiationArchive.objects.filter(content_type=ctype, content_pk__in=pks).exclude(
+                content_pk__in=list(statuses)
+            ).only('content_pk', 'state')
+            for archive in archives:
+                statuses[archive.content_pk] = (archive.status_for(user), [])
+        return statuses
+
+    def statuses(self, user, negotiations):
+        """
+        Returns a {negotiation pk: (status, allowed transitions)} dict for the passed (already loaded) negotiations,
+        like statuses_for() does for negotiables.
+        """
+        if not negotiations:
+            return {}
+
+        part_ids = set()
+        for negotiation in negotiations:
+            part_ids.update((negotiation.client_id, negotiation.seller_id))
+        user_part_ids = set(
+            User.groups.through.objects.filter(user=user.pk, group__in=part_ids).values_list('group_id', flat=True)
+        ) if user.pk is not None else set()
+
+        statuses = {}
+        for negotiation in negotiations:
+            if not negotiation.has_summary:
+                statuses[negotiation.pk] = (
+                    negotiation.status_for(user), negotiation.allowed_transitions(user)
+                )
+                continue
+            state_name = negotiation.state_name.upper()
+            if state_name == 'NEGOTIATING':
+                state_name = 'LAST_UPDATER' if user.pk == negotiation.last_updater_user_id else 'COUNTERPART'
+            side = _side(negotiation.client_id in user_part_ids, negotiation.seller_id in user_part_ids)
+            statuses[negotiation.pk] = (STATUSES[state_name], negotiation._allowed_transitions(side))
+        return statuses
+
+
+def _side(in_client, in_seller):
+    # the side of a user in a negotiation, as indexed in TRANSITION_MATRIX
+    if in_client:
+        return 'both' if in_seller else 'client'
+    return 'seller' if in_seller else None
+
+
+# Process-wide membership generations, bumped whenever a group membership changes. The '*' entry invalidates every
+# group at once (used when the affected groups are unknown).
+_membership_generations = {'*': 0}
+
+
+def _membership_generation(group_pk):
+    return _membership_generations['*'], _membership_generations.get(group_pk, 0)
+
+
+def invalidate_membership(group_pks=None):
+    if group_pks is None:
+        _membership_generations['*'] += 1
+    else:
+        for group_pk in group_pks:
+            _membership_generations[group_pk] = _membership_generations.get(group_pk, 0) + 1
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def membership_changed(sender, instance, action, pk_set, **kwargs):
+    if action == 'pre_clear':
+        if isinstance(instance, Group):
+            # the removed members are unknown after clearing, and their pending counts must be forgotten
+            instance._cleared_member_pks = list(instance.user_set.values_list('pk', flat=True))
+        else:
+            # the cleared groups are unknown after clearing
+            bump_members_version(instance.groups.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if isinstance(instance, Group):
+        invalidate_membership([instance.pk])
+        bump_members_version([instance.pk])
+        refresh_group_inboxes([instance.pk])
+        # refresh_inboxes() only forgets the counts of the remaining members
+        if action == 'post_remove':
+            forget_pending_counts(pk_set)
+        elif action == 'post_clear':
+            forget_pending_counts(instance.__dict__.pop('_cleared_member_pks', []))
+    elif pk_set:
+        invalidate_membership(pk_set)
+        bump_members_version(pk_set)
+        refresh_group_inboxes(pk_set)
+        if action == 'post_remove':
+            forget_pending_counts([instance.pk])
+    else:
+        invalidate_membership()
+        if action == 'post_clear':  # the user was removed from every group: nothing can be pending for them
+            NegotiationInbox.objects.filter(user=instance.pk).delete()
+            forget_pending_counts([instance.pk])
+
+
+@receiver(post_save, sender=User)
+def member_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and not {'first_name', 'last_name'} & set(update_fields)):
+        return  # e.g. last_login updates do not change how members are rendered
+    bump_members_version(instance.groups.values_list('pk', flat=True))
+
+
+if NEGOTIATION_PROFILE_MODEL:
+    @receiver(post_save)
+    def member_profile_saved(sender, instance, **kwargs):
+        if '%s.%s' % (sender._meta.app_label, sender._meta.object_name) == NEGOTIATION_PROFILE_MODEL:
+            bump_members_version(User.groups.through.objects.filter(
+                user=instance.user_id
+            ).values_list('group_id', flat=True))
+
+
+class NegotiationAutoGroup(models.Model):
+    """
+    Marks a group created automatically for a single user as a negotiation part, so the negotiation_sweep_groups
+    command only deletes these groups once no negotiation references them.
+    """
+    group = models.OneToOneField(Group, primary_key=True, related_name='negotiation_auto_group')
 
 
 class NegotiationPart(Group):
@@ -82,9 +459,57 @@ class NegotiationPart(Group):
     class Meta:
         proxy = True
 
+    @classmethod
+    def for_user(cls, user, name):
+        """
+        Returns a part made of a single user: the canonical group of the user when NEGOTIATION_REUSE_USER_GROUPS is on
+        (created the first time it is needed), or else a new group with the passed name.
+        """
+        if settings.NEGOTIATION_REUSE_USER_GROUPS:
+            part, created = cls.objects.get_or_create(name=NEGOTIATION_USER_GROUP_NAME % user.pk)
+        else:
+            part, created = cls.objects.create(name=name), True
+        if created:
+            part.user_set.add(user)
+            NegotiationAutoGroup.objects.create(group=part)
+        return part
+
+    def _membership(self):
+        """
+        Returns the membership memo of this instance: a {user pk: is member} dict and the set of members (if loaded).
+        The memo lives as long as the instance and is dropped when the group membership changes.
+        """
+        generation = _membership_generation(self.pk)
+        memo = getattr(self, '_membership_memo', None)
+        if memo is None or memo['generation'] != generation:
+            memo = {'generation': generation, 'checks': {}, 'users': None}
+            members = self.user_set.all()
+            if members._result_cache is not None:  # members were prefetched
+                memo['users'] = set(members)
+            self._membership_memo = memo
+        return memo
+
     @property
     def users(self):
-        return set(self.user_set.all())
+        memo = self._membership()
+        if memo['users'] is None:
+            memo['users'] = set(self.user_set.all())
+        return memo['users']
+
+    def has_member(self, user):
+        """
+        Returns whether 'user' belongs to this part, using a single EXISTS query the first time it is asked.
+        """
+        if user is None or user.pk is None:
+            return False
+        memo = self._membership()
+        if memo['users'] is not None:
+            return user in memo['users']
+        try:
+            return memo['checks'][user.pk]
+        except KeyError:
+            is_member = memo['checks'][user.pk] = self.user_set.filter(pk=user.pk).exists()
+            return is_member
 
     def make_last_updater(self, negotiation):
         role = (local_rol for local_rol in get_local_roles(negotiation, self)
@@ -123,44 +548,244 @@ class Negotiation(models.Model):
     # Metadata
     updated = models.DateTimeField(auto_now=True)
 
+    # Summary of the latest transition (maintained by every transition)
+    last_updater_user = models.ForeignKey(User, null=True, blank=True, related_name='+')
+    last_updater_role = models.ForeignKey(Role, null=True, blank=True, related_name='+')
+    rounds = models.PositiveIntegerField(_('rounds'), default=0)
+    last_transition_at = models.DateTimeField(_('last transition'), null=True, blank=True)
+    latest_client_proposal = models.ForeignKey('NegotiationProposal', null=True, blank=True, related_name='+')
+    latest_seller_proposal = models.ForeignKey('NegotiationProposal', null=True, blank=True, related_name='+')
+
+    # Optimistic concurrency control: increased by every transition
+    version = models.PositiveIntegerField(_('version'), default=0)
+
+    # Code of the current state (see STATE_CODES), null for states unknown to this application
+    state_code = models.PositiveSmallIntegerField(
+        _('state code'), null=True,
+        default=STATE_CODES[WORKFLOWS['negotiation.models.Negotiation']['initial_state']['name']]
+    )
+
     # Custom Manager
     objects = NegotiationManager()
 
     class Meta:
         unique_together = ('content_type', 'content_pk')  # only one negotiation for a content object
+        index_together = (
+            ('content_type', 'state_code'),  # state filters and counts of each negotiable model
+            ('content_type', 'client'),  # for_user()
+            ('content_type', 'seller'),
+        )
         ordering = ('current_state',)
 
     def init_permissions(self):
+        if settings.NEGOTIATION_TURN_BASED:
+            # the turn is enforced by allowed_transitions(), so let the workflow permission checks pass for both parts
+            for role in (client_role(), seller_role()):
+                grant_permission(self, role, last_updater_permission())
+                grant_permission(self, role, counterpart_permission())
+            return
         # set initial permissions for each part
-        acting_part, counter_part = (self.client, self.seller) if self.starter in self.client.users \
+        acting_part, counter_part = (self.client, self.seller) if self.client.has_member(self.starter) \
             else (self.seller, self.client)
         acting_part.make_last_updater(self)
         counter_part.make_counterpart(self)
 
+    def _history_comment(self, content_dict, delta=None):
+        if delta is not None:  # see NEGOTIATION_SNAPSHOT_INTERVAL
+            return serializers.dumps({'delta': delta,
+                                      'notes': self.notes})
+        return serializers.dumps({'content': content_dict,
+                                  'notes': self.notes})
+
     @property
     def history_comment(self):
-        content_dict = self.content.freeze()
-        return json.dumps({'content': content_dict,
-                           'notes': self.notes})
+        return self._history_comment(self.content.freeze())
 
     def _load_history_item(self, version):
-        item = json.loads(version.comment)
-        item.update({
-            'updater': version.user,
-            'updated': version.update_at
-        })
-        return item
-
-    def history(self, recent_first=True):
-        versions = WorkflowHistorical.objects.get_history_from_object_query_set(self)
-        if recent_first:
-            versions = versions.order_by('-update_at')
+        return HistoryItem(version.user, version.update_at, version.comment, pk=version.pk)
+
+    def _load_proposal_item(self, proposal, content=_UNDECODED):
+        if content is _UNDECODED and proposal.is_delta:
+            content = patch(self._content_before(proposal.pk), serializers.loads(proposal.content))
+        return HistoryItem(proposal.actor, proposal.created, proposal.content, proposal.notes, proposal.transition,
+                           content, proposal.pk)
+
+    def _content_before(self, proposal_pk=None):
+        """
+        Returns the content of the latest proposal made before the proposal 'proposal_pk' (or of the latest proposal),
+        rebuilt from the latest full snapshot, or _UNDECODED if there is none.
+        """
+        proposals = self.proposals.order_by('-id')
+        if proposal_pk is not None:
+            proposals = proposals.filter(id__lt=proposal_pk)
+        chain, page_size = [], max(settings.NEGOTIATION_SNAPSHOT_INTERVAL, 1)
+        while not chain or chain[-1].is_delta:
+            page = list((proposals.filter(id__lt=chain[-1].pk) if chain else proposals)[:page_size])
+            if not page:
+                return _UNDECODED
+            for proposal in page:
+                chain.append(proposal)
+                if not proposal.is_delta:
+                    break
+        return list(rebuild_contents(reversed(chain)))[-1][1]
+
+    def _encode_content(self, content_dict):
+        """
+        Returns the payload to store for a new proposal of 'content_dict', and its delta from the previous proposal (or
+        None when a full snapshot is stored).
+        """
+        if settings.NEGOTIATION_SNAPSHOT_INTERVAL > 1 and self.rounds % settings.NEGOTIATION_SNAPSHOT_INTERVAL:
+            previous = self.__dict__.get('_latest_content', _UNDECODED)
+            if previous is _UNDECODED:
+                previous = self._content_before()
+            if previous is not _UNDECODED:
+                delta = diff(previous, content_dict)
+                return serializers.dumps(delta), delta
+        return serializers.dumps(content_dict), None
+
+    @property
+    def has_summary(self):
+        # every negotiation gets at least one round on creation, so an empty summary means a not backfilled row, whose
+        # history still lives only in the workflow history
+        return self.rounds > 0
+
+    def _add_proposal(self, user, transition, content_dict):
+        # stores the proposal, and updates the summary fields of this instance (but does not save them)
+        role = client_role() if self.is_client(user) else seller_role()
+        payload, delta = self._encode_content(content_dict)
+        proposal = NegotiationProposal.objects.create(
+            negotiation=self,
+            actor=user,
+            role=role,
+            transition=transition,
+            notes=self.notes,
+            content=payload,
+            is_delta=delta is not None
+        )
+        proposal.delta = delta  # for the workflow history comment
+        self._latest_content = content_dict
+        fields = {
+            'last_updater_user': user,
+            'last_updater_role': role,
+            'last_transition_at': proposal.created,
+            'rounds': self.rounds + 1,
+        }
+        if role == client_role():
+            fields['latest_client_proposal'] = proposal
         else:
-            versions = versions.order_by('update_at')
-        return (self._load_history_item(version) for version in versions)
+            fields['latest_seller_proposal'] = proposal
+        for name, value in fields.items():
+            setattr(self, name, value)
+        return proposal, fields
+
+    def record_proposal(self, user, transition, content_dict):
+        """
+        Stores the proposal made by 'user' through 'transition' and updates the summary fields in a single query.
+        """
+        proposal, fields = self._add_proposal(user, transition, content_dict)
+        fields['rounds'] = models.F('rounds') + 1
+        Negotiation.objects.filter(pk=self.pk).update(**fields)
+        return proposal
+
+    def backfill_summary(self):
+        """
+        Rebuilds the proposals and the summary fields of this negotiation from the workflow history, for the rows
+        created before the proposals table was introduced. Updates the summary fields of this instance and returns them
+        (but does not save them), or returns None when there is no workflow history to rebuild from (e.g. negotiations
+        started with bulk_negotiate()), leaving their proposals untouched.
+        """
+        client_users = self.client.users
+        versions = WorkflowHistorical.objects.get_history_from_object_query_set(self).order_by('update_at')
+        proposals, previous_role, content = [], None, None
+        for version in versions.iterator():
+            try:
+                item = serializers.loads(version.comment)
+            except (TypeError, ValueError):
+                item = {}
+            # comments hold deltas from the previous content between snapshots (see NEGOTIATION_SNAPSHOT_INTERVAL)
+            content = patch(content, item['delta']) if 'delta' in item else item.get('content')
+            role = client_role() if version.user in client_users else seller_role()
+            # the workflow history does not record transitions: infer them from the sequence of updaters
+            if previous_role is None:
+                transition = START_TRANSITION
+            else:
+                transition = 'Modify' if role == previous_role else 'Negotiate'
+            proposals.append(NegotiationProposal(
+                negotiation=self,
+                actor=version.user,
+                role=role,
+                transition=transition,
+                created=version.update_at,
+                notes=item.get('notes'),
+                content=serializers.dumps(content)
+            ))
+            previous_role = role
+        if not proposals:
+            return None
+        # the latest proposal pointers cascade: clear them, or deleting the proposals would delete the negotiation
+        Negotiation.objects.filter(pk=self.pk).update(latest_client_proposal=None, latest_seller_proposal=None)
+        NegotiationProposal.objects.filter(negotiation=self).delete()
+        closing_transition = CLOSING_TRANSITIONS.get(self.current_state.name)
+        if closing_transition is not None and len(proposals) > 1:
+            proposals[-1].transition = closing_transition
+        NegotiationProposal.objects.bulk_create(proposals)
+
+        latest = proposals[-1]
+        fields = {
+            'rounds': len(proposals),
+            'last_updater_user': latest.actor,
+            'last_updater_role': latest.role,
+            'last_transition_at': latest.created,
+        }
+        for role, field in ((client_role(), 'latest_client_proposal'), (seller_role(), 'latest_seller_proposal')):
+            # bulk_create does not set primary keys, so read the pointers back (using the proposals index)
+            fields[field] = self.proposals.filter(role=role).order_by('-created', '-id').first()
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.__dict__.pop('_latest_content', None)
+        return fields
+
+    def history(self, recent_first=True, limit=None, before=None, after=None, before_id=None, after_id=None):
+        """
+        Returns a generator of the history items of this negotiation. 'limit' bounds the number of items, and 'before'
+        and 'after' (datetimes) only keep the items strictly older or newer than them. A long history is paged through
+        by passing the 'updated' and 'pk' values of the last item of a page as 'before' and 'before_id' (or 'after' and
+        'after_id') of the next one, which keeps the items sharing the timestamp of the page boundary.
+        """
+        if not self.has_summary:
+            versions = WorkflowHistorical.objects.get_history_from_object_query_set(self)
+            versions = _keyset(versions, 'update_at', before, before_id, after, after_id)
+            versions = versions.order_by(*(('-update_at', '-id') if recent_first else ('update_at', 'id')))
+            if limit is not None:
+                versions = versions[:limit]
+            return (self._load_history_item(version) for version in versions)
+        proposals = _keyset(self.proposals.select_related('actor'), 'created', before, before_id, after, after_id)
+        proposals = proposals.order_by(*(('-created', '-id') if recent_first else ('created', 'id')))
+        if limit is not None:
+            proposals = proposals[:limit]
+        return self._proposal_items(proposals, recent_first)
+
+    def _proposal_items(self, proposals, recent_first):
+        proposals = list(proposals)
+        if not any(proposal.is_delta for proposal in proposals):
+            for proposal in proposals:
+                yield self._load_proposal_item(proposal)  # decoded lazily
+            return
+        # rebuild the contents incrementally from the oldest proposal (and the ones before it, if it is a delta)
+        chronological = proposals[::-1] if recent_first else proposals
+        base = self._content_before(chronological[0].pk) if chronological[0].is_delta else None
+        contents = {}
+        for proposal, content in rebuild_contents(chronological, base):
+            if recent_first:
+                contents[proposal.pk] = content
+            else:
+                yield self._load_proposal_item(proposal, content)
+        if recent_first:
+            for proposal in proposals:
+                yield self._load_proposal_item(proposal, contents[proposal.pk])
 
     def _initiator(self):
-        role = client_role() if self.starter in self.client.users else seller_role()
+        role = client_role() if self.client.has_member(self.starter) else seller_role()
         return self.starter, role
 
     @property
@@ -168,11 +793,13 @@ class Negotiation(models.Model):
         return self._initiator()
 
     def _last_updater(self):
-        history_gen = (version for version in self.history())
+        if self.has_summary:
+            return self.last_updater_user, self.last_updater_role
+        history_gen = self.history(limit=1)
         try:
             last_version = history_gen.next()
-            updater = last_version['updater']
-            role = client_role() if updater in self.client.users else seller_role()
+            updater = last_version.updater
+            role = client_role() if self.client.has_member(updater) else seller_role()
         except StopIteration:
             return None
         return updater, role
@@ -182,18 +809,23 @@ class Negotiation(models.Model):
         return self._last_updater()
 
     def is_last_updater(self, user):
+        if self.has_summary:
+            return user.pk == self.last_updater_user_id
         return user == self.last_updater[0]
 
     def has_last_updater_permissions(self, user):
-        last_updater_role = self.last_updater[1]
+        last_updater_role_id = self.last_updater_role_id if self.has_summary else self.last_updater[1].pk
         return (
-            user in self.client.users and last_updater_role == client_role()
+            self.client.has_member(user) and last_updater_role_id == client_role().pk
         ) or (
-            user in self.seller.users and last_updater_role == seller_role()
+            self.seller.has_member(user) and last_updater_role_id == seller_role().pk
         )
 
     def _last_client_proposal(self):
-        client_versions_gen = (version for version in self.history() if version['updater'] in self.client.users)
+        if self.has_summary:
+            proposal = self.latest_client_proposal
+            return self._load_proposal_item(proposal) if proposal is not None else None
+        client_versions_gen = (version for version in self.history() if self.client.has_member(version.updater))
         try:
             return client_versions_gen.next()
         except StopIteration:
@@ -204,7 +836,10 @@ class Negotiation(models.Model):
         return self._last_client_proposal()
 
     def _last_seller_proposal(self):
-        seller_versions_gen = (version for version in self.history() if version['updater'] in self.seller.users)
+        if self.has_summary:
+            proposal = self.latest_seller_proposal
+            return self._load_proposal_item(proposal) if proposal is not None else None
+        seller_versions_gen = (version for version in self.history() if self.seller.has_member(version.updater))
         try:
             return seller_versions_gen.next()
         except StopIteration:
@@ -220,51 +855,375 @@ class Negotiation(models.Model):
     def last_counterpart_proposal_for(self, user):
         return self.last_seller_proposal if self.is_client(user) else self.last_client_proposal
 
+    @property
+    def turn(self):
+        """
+        Returns the role of the part expected to act next (the counterpart of the last updater).
+        """
+        last_updater_role_id = self._last_updater_role_id()
+        if last_updater_role_id is None:
+            return None
+        return seller_role() if last_updater_role_id == client_role().pk else client_role()
+
+    def _last_updater_role_id(self):
+        if self.has_summary:
+            return self.last_updater_role_id
+        last_updater = self.last_updater  # read from the workflow history of the rows not backfilled yet
+        return last_updater[1].pk if last_updater is not None else None
+
+    @property
+    def state_name(self):
+        """
+        Returns the name of the current state, read from state_code when possible to spare loading the state.
+        """
+        return STATE_NAMES.get(self.state_code) or self.current_state.name
+
+    def side_of(self, user):
+        """
+        Returns the part(s) 'user' belongs to: 'client', 'seller', 'both' or None. Cached on this instance until the
+        next transition or a membership change of the parts.
+        """
+        generation = (_membership_generation(self.client_id), _membership_generation(self.seller_id))
+        cached = self.__dict__.get('_sides')
+        if cached is None or cached[0] != generation:
+            cached = self.__dict__['_sides'] = (generation, {})
+        sides = cached[1]
+        if user.pk not in sides:
+            sides[user.pk] = _side(self.client.has_member(user), self.seller.has_member(user))
+        return sides[user.pk]
+
+    def _allowed_transitions(self, side):
+        last_updater_role_id = self._last_updater_role_id()
+        if last_updater_role_id is None:  # no proposal at all: nobody can act
+            return []
+        turn = 'seller' if last_updater_role_id == client_role().pk else 'client'
+        transitions = negotiation_transitions()
+        return [transitions[name] for name in TRANSITION_MATRIX.get((self.state_name, turn, side), ())]
+
+    def allowed_transitions(self, user):
+        """
+        Returns the transitions 'user' is allowed to make, looked up in TRANSITION_MATRIX from the current state, whose
+        turn it is and the side of the user, instead of checking the object permissions (which follow the same rules,
+        except in turn-based mode where both parts hold both permissions).
+        """
+        return self._allowed_transitions(self.side_of(user))
+
     def is_client(self, user):
-        return user in self.client.users
+        return self.side_of(user) in ('client', 'both')
 
     def is_seller(self, user):
-        return user in self.seller.users
+        return self.side_of(user) in ('seller', 'both')
+
+    def _transition(self, name, user, notes):
+        """
+        Runs the transition 'name' in a single transaction: one insert for the proposal, then the workflow transition,
+        whose save writes the notes and the summary fields along with the new state in one UPDATE (and logs the
+        workflow history). Returns whether the transition was allowed.
+        """
+        if name not in [transition.name for transition in self.allowed_transitions(user)]:
+            return False
+        content_dict = self.content.freeze()  # the negotiable instance is reused when loaded through it
+        previous = self.__dict__.copy()
+        try:
+            with transaction.atomic():
+                # the workflow transition's save will only update the row if it still has the version loaded
+                self._expected_version = self.version
+                self.version += 1
+                self.notes = notes
+                self.state_code = STATE_CODES.get(TRANSITION_DESTINATIONS[name])
+                backfilled = not self.has_summary
+                if backfilled:
+                    # not backfilled yet (see the negotiation_backfill command): rebuild the earlier proposals first,
+                    # so the new one is appended to the whole history instead of starting a summary of its own
+                    self.backfill_summary()
+                proposal = self._add_proposal(user, name, content_dict)[0]
+                comment = self._history_comment(content_dict, proposal.delta)
+                if not getattr(self, 'do_%s' % name.lower())(user, comment):
+                    raise TransitionNotAllowed(name)
+                if name == 'Negotiate' and not settings.NEGOTIATION_TURN_BASED:
+                    # the counter-proposal swaps the permissions of the parts (a modification keeps them)
+                    acting_role = proposal.role
+                    counter_role = seller_role() if acting_role == client_role() else client_role()
+                    remove_permission(self, acting_role, counterpart_permission())
+                    grant_permission(self, acting_role, last_updater_permission())
+                    remove_permission(self, counter_role, last_updater_permission())
+                    grant_permission(self, counter_role, counterpart_permission())
+                # a modification leaves the turn to the same part, unless the negotiation had no inbox entries yet
+                if name != 'Modify' or backfilled:
+                    refresh_inboxes([self.pk])
+        except (TransitionNotAllowed, StaleNegotiation) as e:
+            # the transaction was rolled back: roll back this instance too
+            self.__dict__.clear()
+            self.__dict__.update(previous)
+            if isinstance(e, StaleNegotiation):
+                raise
+            return False
+        finally:
+            self.__dict__.pop('_expected_version', None)
+        self.__dict__.pop('_sides', None)
+        return True
 
-    def _save_notes(self, notes):
-        self.notes = notes
-        self.save()
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # compare-and-swap on the version during transitions (see _transition), which only write the state and summary
+        # columns (the workflow engine's save takes no update_fields)
+        expected_version = getattr(self, '_expected_version', None)
+        if expected_version is None:
+            return models.Model._do_update(self, base_qs, using, pk_val, values, update_fields, forced_update)
+        base_qs = base_qs.filter(version=expected_version)
+        values = [value for value in values if value[0].name in TRANSITION_UPDATE_FIELDS]
+        if not models.Model._do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+            raise StaleNegotiation("Negotiation %s was changed since it was loaded." % pk_val)
+        return True
+
+    def reload(self):
+        """
+        Reloads the fields of this instance from the database, keeping the cached related objects that did not change.
+        """
+        fresh = Negotiation.objects.get(pk=self.pk)
+        self.__dict__.pop('_latest_content', None)  # other proposals may have been made since
+        self.__dict__.pop('_sides', None)  # and the parts may have changed
+        for field in self._meta.concrete_fields:
+            value = getattr(fresh, field.attname)
+            if isinstance(field, models.ForeignKey) and getattr(self, field.attname) != value:
+                self.__dict__.pop(field.get_cache_name(), None)
+            setattr(self, field.attname, value)
+
+    def retrying(self, transition, user, notes="", attempts=3, **kwargs):
+        """
+        Runs 'transition' ('accept', 'cancel', 'negotiate' or 'modify'), reloading this negotiation and trying again
+        (up to 'attempts' times in total) when it was changed concurrently. The transition is checked against the
+        reloaded state, so it is refused when it no longer applies. Raises StaleNegotiation if every attempt failed.
+        """
+        for attempt in range(attempts):
+            try:
+                return getattr(self, transition)(user, notes, **kwargs)
+            except StaleNegotiation:
+                if attempt == attempts - 1:
+                    raise
+                self.reload()
 
     def accept(self, user, notes="", **kwargs):
-        self._save_notes(notes)
-        return self.do_accept(user, self.history_comment)
+        return self._transition('Accept', user, notes)
 
     def cancel(self, user, notes="", **kwargs):
-        self._save_notes(notes)
-        return self.do_cancel(user, self.history_comment)
+        return self._transition('Cancel', user, notes)
 
     def negotiate(self, user, notes="", **kwargs):
-        self._save_notes(notes)
-        result = self.do_negotiate(user, self.history_comment)
-        # update permissions for each part
-        acting_part, counter_part = (self.client, self.seller) if user in self.client.users else (self.seller, self.client)
-        acting_part.make_last_updater(self)
-        counter_part.make_counterpart(self)
-        return result
+        return self._transition('Negotiate', user, notes)
 
     def modify(self, user, notes="", **kwargs):
-        self._save_notes(notes)
-        result = self.do_modify(user, self.history_comment)
-        # update permissions for each part
-        acting_part, counter_part = (self.client, self.seller) if user in self.client.users else (self.seller, self.client)
-        acting_part.make_last_updater(self)
-        counter_part.make_counterpart(self)
-        return result
+        return self._transition('Modify', user, notes)
 
     def status_for(self, user):
-        statuses = {
-            'LAST_UPDATER': (_(u'WAITING FOR COUNTERPART'), 'waiting'),
-            'COUNTERPART': (_(u'PENDING ACTION'), 'pending'),
-            'ACCEPTED': (_(u'ACCEPTED'), 'accepted'),
-            'CANCELLED': (_(u'CANCELLED'), 'cancelled'),
-        }
-        state_name = self.current_state.name.upper()
+        state_name = self.state_name.upper()
         if state_name == 'NEGOTIATING':
             state_name = 'LAST_UPDATER' if self.is_last_updater(user) else 'COUNTERPART'
 
-        return statuses[state_name]
\ No newline at end of file
+        return STATUSES[state_name]
+
+
+instrument(NegotiationManager, 'negotiation.objects', ['pending_count_for', 'statuses_for', 'statuses'])
+# history() is left out: it returns a lazy generator, whose queries only run when its items are consumed
+instrument(Negotiation, 'negotiation', [
+    'init_permissions', 'history_comment', 'record_proposal', 'initiator', 'last_updater', 'is_last_updater',
+    'has_last_updater_permissions', 'last_client_proposal', 'last_seller_proposal', 'last_proposal_from',
+    'last_counterpart_proposal_for', 'turn', 'side_of', 'allowed_transitions', 'is_client', 'is_seller', 'reload',
+    'retrying',
+    'accept', 'cancel', 'negotiate', 'modify', 'status_for',
+])
+
+
+class NegotiationProposal(models.Model):
+    """
+    A proposal made in a negotiation, by one of its parts, through one of the workflow transitions.
+    """
+    negotiation = models.ForeignKey(Negotiation, related_name='proposals')
+    actor = models.ForeignKey(User, related_name='+')
+    role = models.ForeignKey(Role, related_name='+')
+    transition = models.CharField(_('transition'), max_length=100)
+    created = models.DateTimeField(_('created'), default=now)
+    notes = models.TextField(_('notes'), max_length=1000, null=True)
+    content = models.TextField(_('content'))  # frozen content of the negotiable
+    is_delta = models.BooleanField(_('delta'), default=False)  # content holds the changes from the previous proposal
+
+    class Meta:
+        index_together = (('negotiation', 'role', 'created'),)
+
+
+class NegotiationInbox(models.Model):
+    """
+    A negotiation waiting for an action of a user: there is one for each member of the part expected to act next in
+    every negotiation still negotiating, maintained by the transitions and the membership changes (see
+    refresh_inboxes).
+    """
+    user = models.ForeignKey(User, related_name='+')
+    negotiation = models.ForeignKey(Negotiation, related_name='inbox')
+
+    class Meta:
+        unique_together = ('user', 'negotiation')
+
+
+def refresh_inboxes(negotiation_ids, chunk_size=500):
+    """
+    Rebuilds the inbox entries of the passed negotiations, and invalidates the pending counts of the members of their
+    parts, with three queries for each chunk of negotiations whatever the number of members (the chunks keep the
+    number of query parameters bounded).
+    """
+    negotiation_ids = list(negotiation_ids)
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for start in range(0, len(negotiation_ids), chunk_size):
+        chunk = negotiation_ids[start:start + chunk_size]
+        names = {
+            'negotiation': qn(Negotiation._meta.db_table),
+            'inbox': qn(NegotiationInbox._meta.db_table),
+            'membership': qn(User.groups.through._meta.db_table),
+            'ids': ', '.join(['%s'] * len(chunk)),
+        }
+        cursor.execute(
+            "SELECT DISTINCT m.user_id FROM %(membership)s m, %(negotiation)s n "
+            "WHERE n.id IN (%(ids)s) AND m.group_id IN (n.client_id, n.seller_id)" % names,
+            chunk
+        )
+        user_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM %(inbox)s WHERE negotiation_id IN (%(ids)s)" % names, chunk)
+        # the part expected to act next is the counterpart of the last updater (unknown when not backfilled yet)
+        cursor.execute(
+            "INSERT INTO %(inbox)s (user_id, negotiation_id) "
+            "SELECT m.user_id, n.id FROM %(membership)s m, %(negotiation)s n "
+            "WHERE n.id IN (%(ids)s) AND n.state_code = %%s AND n.last_updater_role_id IS NOT NULL "
+            "AND m.group_id = CASE WHEN n.last_updater_role_id = %%s THEN n.seller_id ELSE n.client_id END" % names,
+            chunk + [NEGOTIATING, client_role().pk]
+        )
+        forget_pending_counts(user_ids)
+
+
+def refresh_group_inboxes(group_pks):
+    """
+    Rebuilds the inbox entries of the negotiations still negotiating with one of the passed groups as a part.
+    """
+    refresh_inboxes(Negotiation.objects.filter(state_code=NEGOTIATING).filter(
+        models.Q(client__in=group_pks) | models.Q(seller__in=group_pks)
+    ).values_list('pk', flat=True))
+
+
+class NegotiationArchive(models.Model):
+    """
+    A closed negotiation moved out of the negotiation, proposal, workflow history and permission tables (see the
+    negotiation_archive command), with its whole history compressed in a single blob. The negotiation property of the
+    negotiables falls back to it, so history(), status_for() and the last proposal helpers keep working.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'), related_name='+')
+    content_pk = models.IntegerField(_('content ID'))
+    content = GenericForeignKey(ct_field="content_type", fk_field="content_pk")
+    starter = models.ForeignKey(User, related_name='+')
+    client = models.ForeignKey(NegotiationPart, related_name='archived_as_client')
+    seller = models.ForeignKey(NegotiationPart, related_name='archived_as_seller')
+    state = models.CharField(_('state'), max_length=100)
+    notes = models.TextField(max_length=1000, null=True)
+    last_updater_user = models.ForeignKey(User, null=True, blank=True, related_name='+')
+    last_updater_role = models.ForeignKey(Role, null=True, blank=True, related_name='+')
+    rounds = models.PositiveIntegerField(_('rounds'), default=0)
+    updated = models.DateTimeField(_('updated'))
+    archived = models.DateTimeField(_('archived'), default=now)
+    # zlib compressed JSON list of [updater pk, role ('client' or 'seller'), transition, updated (ISO 8601), notes,
+    # content] items in chronological order, the content being the JSON payload stored in the proposal
+    history_blob = models.BinaryField(_('history'))
+
+    class Meta:
+        unique_together = ('content_type', 'content_pk')
+
+    @staticmethod
+    def encode_history(items):
+        return zlib.compress(json.dumps(items).encode('utf-8'))
+
+    def _history_items(self):
+        if '_decoded_history' not in self.__dict__:
+            self._decoded_history = json.loads(zlib.decompress(bytes(self.history_blob)).decode('utf-8'))
+        return self._decoded_history
+
+    def _last_proposal_of(self, side):
+        # the latest history item of the part 'side' ('client' or 'seller')
+        items = list(enumerate(self._history_items(), 1))
+        for pk, (updater, role, transition, updated, notes, content) in reversed(items):
+            if role is None:  # archived before being backfilled: the role was not recorded
+                role = 'client' if self.client.has_member(User(pk=updater)) else 'seller'
+            if role == side:
+                return HistoryItem(User.objects.filter(pk=updater).first(), parse_datetime(updated), content, notes,
+                                   transition, pk=pk)
+        return None
+
+    def history(self, recent_first=True, limit=None, before=None, after=None, before_id=None, after_id=None):
+        """
+        Returns a generator of the history items of the archived negotiation, like Negotiation.history() (their 'pk' is
+        their position in the history).
+        """
+        items = []
+        for pk, (updater, role, transition, updated, notes, content) in enumerate(self._history_items(), 1):
+            key = (parse_datetime(updated), pk)
+            if (before is None or key < (before, before_id or 0)) and \
+                    (after is None or key > (after, after_id or float('inf'))):
+                items.append((updater, key[0], content, notes, transition, pk))
+        if recent_first:
+            items.reverse()
+        if limit is not None:
+            items = items[:limit]
+        users = User.objects.in_bulk(set(item[0] for item in items)) if items else {}
+        return (HistoryItem(users.get(updater), updated, content, notes, transition, pk=pk)
+                for updater, updated, content, notes, transition, pk in items)
+
+    @property
+    def is_negotiating(self):
+        return False
+
+    @property
+    def is_accepted(self):
+        return self.state == 'Accepted'
+
+    @property
+    def is_cancelled(self):
+        return self.state == 'Cancelled'
+
+    @property
+    def initiator(self):
+        return self.starter, client_role() if self.client.has_member(self.starter) else seller_role()
+
+    @property
+    def last_updater(self):
+        return self.last_updater_user, self.last_updater_role
+
+    def is_last_updater(self, user):
+        return user.pk == self.last_updater_user_id
+
+    def has_last_updater_permissions(self, user):
+        return (
+            self.client.has_member(user) and self.last_updater_role_id == client_role().pk
+        ) or (
+            self.seller.has_member(user) and self.last_updater_role_id == seller_role().pk
+        )
+
+    @property
+    def last_client_proposal(self):
+        return self._last_proposal_of('client')
+
+    @property
+    def last_seller_proposal(self):
+        return self._last_proposal_of('seller')
+
+    def last_proposal_from(self, user):
+        return self.last_client_proposal if self.is_client(user) else self.last_seller_proposal
+
+    def last_counterpart_proposal_for(self, user):
+        return self.last_seller_proposal if self.is_client(user) else self.last_client_proposal
+
+    def is_client(self, user):
+        return self.client.has_member(user)
+
+    def is_seller(self, user):
+        return self.seller.has_member(user)
+
+    def allowed_transitions(self, user):
+        return []
+
+    def status_for(self, user):
+        return STATUSES[self.state.upper()]
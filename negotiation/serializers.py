@@ -0,0 +1,104 @@
+# coding=utf-8
+"""
+Serializers of the proposal contents and workflow history payloads, chosen with NEGOTIATION_SERIALIZER. Payloads of
+every serializer but plain JSON start with a format marker, so the payloads written with any of them stay readable
+after changing the setting. Binary formats are base64 encoded, as payloads are stored in text columns.
+"""
+import base64
+import json
+import zlib
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_by_path
+from settings import NEGOTIATION_SERIALIZER
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONSerializer(object):
+    marker = ''
+
+    def dumps(self, value):
+        return json.dumps(value)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class ZlibJSONSerializer(object):
+    """
+    zlib compressed JSON, for large contents.
+    """
+    marker = 'z:'
+
+    def dumps(self, value):
+        return self.marker + base64.b64encode(zlib.compress(json.dumps(value).encode('utf-8'))).decode('ascii')
+
+    def loads(self, data):
+        return json.loads(zlib.decompress(base64.b64decode(data[len(self.marker):])).decode('utf-8'))
+
+
+class MsgpackSerializer(object):
+    """
+    MessagePack, faster to decode than JSON. Requires the msgpack package.
+    """
+    marker = 'm:'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImproperlyConfigured("The msgpack package is required to read or write msgpack negotiation payloads.")
+
+    def dumps(self, value):
+        return self.marker + base64.b64encode(msgpack.packb(value, use_bin_type=True)).decode('ascii')
+
+    def loads(self, data):
+        data = base64.b64decode(data[len(self.marker):])
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except TypeError:  # msgpack < 0.5.2
+            return msgpack.unpackb(data, encoding='utf-8')
+
+
+SERIALIZERS = {
+    'json': JSONSerializer,
+    'zlib-json': ZlibJSONSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+_serializer = None
+_readers = {}
+
+
+def configure(name):
+    """
+    Sets the serializer used to write payloads: one of SERIALIZERS, or the dotted path of a serializer class (with a
+    unique 'marker' prefix, and 'dumps' and 'loads' methods).
+    """
+    global _serializer
+    serializer_class = SERIALIZERS[name] if name in SERIALIZERS else import_by_path(name)
+    _serializer = serializer_class()
+    _readers[_serializer.marker] = _serializer
+    return _serializer
+
+
+def dumps(value):
+    return _serializer.dumps(value)
+
+
+def loads(data):
+    """
+    Decodes a payload written with any serializer (plain JSON if it has no known marker).
+    """
+    marker = data[:2]
+    if marker in _readers:
+        return _readers[marker].loads(data)
+    for serializer_class in SERIALIZERS.values():
+        if serializer_class.marker and serializer_class.marker == marker:
+            _readers[marker] = serializer_class()
+            return _readers[marker].loads(data)
+    return json.loads(data)
+
+
+configure(NEGOTIATION_SERIALIZER)
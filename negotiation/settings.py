@@ -1,5 +1,7 @@
 # coding=utf-8
 from django.conf import settings as django_settings
+from django.dispatch import receiver
+from django.test.signals import setting_changed
 
 # WORKFLOWS DEFINITIONS
 
@@ -76,4 +78,78 @@ WORKFLOWS = {
 # APPLICATION WORKFLOWS
 workflows = getattr(django_settings, 'WORKFLOWS', {})
 workflows.update(WORKFLOWS)
-setattr(django_settings, 'WORKFLOWS', workflows)
\ No newline at end of file
+setattr(django_settings, 'WORKFLOWS', workflows)
+
+# PARTS
+
+# When a negotiation is started with a single user as client or seller (instead of a group), reuse one canonical
+# single-member group per user instead of creating a new group for every negotiation. Members must not be added to
+# these groups, since they are shared by every negotiation of their user.
+NEGOTIATION_REUSE_USER_GROUPS = getattr(django_settings, 'NEGOTIATION_REUSE_USER_GROUPS', False)
+
+# Name of the canonical group of each user (formatted with the user's pk)
+NEGOTIATION_USER_GROUP_NAME = getattr(django_settings, 'NEGOTIATION_USER_GROUP_NAME', 'negotiation-user-%s')
+
+# TURNS
+
+# Derive the allowed transitions from whose turn it is (the summary of the latest transition) instead of moving the
+# object permissions of both parts on every counter-proposal. Object permissions are then only written once, when the
+# negotiation starts. Negotiations started before enabling it need 'python manage.py negotiation_turn_permissions'.
+NEGOTIATION_TURN_BASED = getattr(django_settings, 'NEGOTIATION_TURN_BASED', False)
+
+# STORAGE
+
+# Store a full snapshot of the negotiable content every this number of rounds only, and the changes from the previous
+# proposal (a JSON-patch-like delta) in between, in both the proposals and the workflow history. 1 stores a full
+# snapshot in every proposal.
+NEGOTIATION_SNAPSHOT_INTERVAL = getattr(django_settings, 'NEGOTIATION_SNAPSHOT_INTERVAL', 1)
+
+# Serializer of the proposal contents and workflow history payloads: 'json', 'zlib-json' (compressed), 'msgpack' (if
+# installed) or the dotted path of a serializer class (see negotiation.serializers). Payloads written with any of them
+# stay readable after changing it.
+NEGOTIATION_SERIALIZER = getattr(django_settings, 'NEGOTIATION_SERIALIZER', 'json')
+
+# CACHING
+
+# Version of the constants (roles, permissions, workflow and transitions) stored in the shared cache. Increase it
+# whenever their definitions change, to stop reading the values cached by previous releases.
+NEGOTIATION_CACHE_VERSION = getattr(django_settings, 'NEGOTIATION_CACHE_VERSION', 1)
+
+# Seconds a constant is served from the in-process cache before checking the shared cache again (so a flush performed
+# by another process is seen after at most this long).
+NEGOTIATION_LOCAL_CACHE_TIMEOUT = getattr(django_settings, 'NEGOTIATION_LOCAL_CACHE_TIMEOUT', 300)
+
+# Seconds the rendered member lists of the parts are cached (they are invalidated whenever the members change)
+NEGOTIATION_MEMBERS_CACHE_TIMEOUT = getattr(django_settings, 'NEGOTIATION_MEMBERS_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# Seconds the number of negotiations pending for each user is cached (it is invalidated by the transitions and the
+# membership changes, so this only bounds how long a count read while a transaction was running can be served)
+NEGOTIATION_PENDING_COUNT_CACHE_TIMEOUT = getattr(django_settings, 'NEGOTIATION_PENDING_COUNT_CACHE_TIMEOUT', 60 * 5)
+
+# Model of the user profiles linked by render_members ('app_label.ModelName', with a 'user' field), whose changes
+# invalidate the cached member lists
+NEGOTIATION_PROFILE_MODEL = getattr(django_settings, 'NEGOTIATION_PROFILE_MODEL',
+                                    getattr(django_settings, 'AUTH_PROFILE_MODULE', None))
+
+# INSTRUMENTATION
+
+# Sink receiving the time and number of queries of the negotiation operations, and the cache hits and misses: None
+# (disabled), 'logging', 'memory', 'statsd' or the dotted path of a sink class (see negotiation.instrumentation).
+NEGOTIATION_INSTRUMENTATION = getattr(django_settings, 'NEGOTIATION_INSTRUMENTATION', None)
+
+# Address and metrics prefix of the statsd server of the 'statsd' sink
+NEGOTIATION_STATSD_ADDRESS = getattr(django_settings, 'NEGOTIATION_STATSD_ADDRESS', ('127.0.0.1', 8125))
+NEGOTIATION_STATSD_PREFIX = getattr(django_settings, 'NEGOTIATION_STATSD_PREFIX', 'negotiation')
+
+# TESTS
+
+# Settings read at call time (as negotiation.settings attributes), which override_settings() can change
+_runtime_defaults = dict((name, globals()[name]) for name in (
+    'NEGOTIATION_REUSE_USER_GROUPS', 'NEGOTIATION_TURN_BASED', 'NEGOTIATION_SNAPSHOT_INTERVAL'
+))
+
+
+@receiver(setting_changed)
+def _update_runtime_setting(sender, setting, **kwargs):
+    if setting in _runtime_defaults:
+        globals()[setting] = getattr(django_settings, setting, _runtime_defaults[setting])
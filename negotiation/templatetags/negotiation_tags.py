@@ -1,33 +1,86 @@
 #coding=utf-8
 import logging
 from django import template
-from django.contrib.contenttypes.models import ContentType
-from django.template.loader import render_to_string
+from django.conf import settings
+from django.db.models.query import prefetch_related_objects
+from django.template.loader import select_template
+from ..caching import cached_members
+from ..decorators import attach_statuses
+from ..instrumentation import measure
+from ..models import Negotiation, NegotiationArchive
 logger = logging.getLogger(__name__)
 register = template.Library()
 
+PRELOAD_LOOKUPS = [
+    'negotiations__current_state',
+    'negotiations__client__user_set',
+    'negotiations__seller__user_set',
+    'negotiation_archives',
+]
+
+# resolved negotiation buttons template for each (app label, model, scope)
+_buttons_templates = {}
+
+
+def negotiation_buttons_template(app_label, model_name, scope=''):
+    key = (app_label, model_name, scope)
+    try:
+        return _buttons_templates[key]
+    except KeyError:
+        pass
+    buttons_template = select_template([
+        "%s/%s/%s/negotiation_buttons.html" % (app_label, model_name, scope),
+        "%s/%s/negotiation_buttons.html" % (app_label, model_name),
+        "%s/negotiation_buttons.html" % app_label,
+        "negotiation_buttons.html",
+    ])
+    if not settings.DEBUG:  # let templates be edited while developing
+        _buttons_templates[key] = buttons_template
+    return buttons_template
+
+
+@register.simple_tag
+def preload_negotiations(object_list, user):
+    """
+    Loads in bulk everything the negotiation tags need to render the negotiables of a list for 'user' (negotiations,
+    states, parts and their members, statuses and options), and attaches it to the objects, so rendering the list
+    costs a fixed number of queries. Use it before iterating the list:
+        {% preload_negotiations object_list user %}
+    """
+    with measure('tags.preload_negotiations'):
+        objects = list(object_list)
+        if not objects:
+            return ''
+        prefetch_related_objects(objects, PRELOAD_LOOKUPS)
+        negotiations = dict((obj.pk, obj.negotiation) for obj in objects if obj.negotiation is not None)
+        archived = dict((pk, negotiation) for pk, negotiation in negotiations.items()
+                        if isinstance(negotiation, NegotiationArchive))
+        statuses = Negotiation.objects.statuses(
+            user, [negotiation for pk, negotiation in negotiations.items() if pk not in archived]
+        )
+        object_statuses = dict((pk, (archive.status_for(user), [])) for pk, archive in archived.items())
+        object_statuses.update((pk, statuses[negotiation.pk]) for pk, negotiation in negotiations.items()
+                               if pk not in archived)
+        attach_statuses(objects, user, object_statuses)
+        return ''
+
 
 @register.simple_tag(takes_context=True)
 def render_negotiation_options(context, negotiable, scope='', kwargs={}):
-    if negotiable.negotiation is not None:
-        ctype = ContentType.objects.get_for_model(negotiable)
-        template_search_list = [
-            "%s/%s/%s/negotiation_buttons.html" % (ctype.app_label, ctype.model, scope),
-            "%s/%s/negotiation_buttons.html" % (ctype.app_label, ctype.model),
-            "%s/negotiation_buttons.html" % ctype.app_label,
-            "negotiation_buttons.html",
-        ]
-        return render_to_string(
-            template_search_list, {
+    with measure('tags.render_negotiation_options'):
+        if negotiable.negotiation is not None:
+            buttons_template = negotiation_buttons_template(
+                negotiable._meta.app_label, negotiable._meta.model_name, scope
+            )
+            return buttons_template.render(template.Context({
                 'object': negotiable,
                 'transitions': negotiable.negotiation_options(
                     context['user']
                 ),
                 'user': context['user']
-            }
-        )
-    else:
-        return ''
+            }))
+        else:
+            return ''
 
 
 @register.filter
@@ -35,12 +88,13 @@ def is_last_updater(negotiable, user):
     """
     Returns whether a user is the last updater of the passed negotiable or not.
     """
-    #noinspection PyBroadException
-    try:
-        return negotiable.is_last_updater(user)
-    except Exception as e:
-        logger.exception(e)
-        return False
+    with measure('tags.is_last_updater'):
+        #noinspection PyBroadException
+        try:
+            return negotiable.is_last_updater(user)
+        except Exception as e:
+            logger.exception(e)
+            return False
 
 
 @register.filter
@@ -48,77 +102,87 @@ def has_last_updater_permissions(negotiable, user):
     """
     Returns whether a user has last updater permissions on the passed negotiable or not.
     """
-    #noinspection PyBroadException
-    try:
-        return negotiable.negotiation.has_last_updater_permissions(user)
-    except Exception as e:
-        logger.exception(e)
-        return False
+    with measure('tags.has_last_updater_permissions'):
+        #noinspection PyBroadException
+        try:
+            return negotiable.negotiation.has_last_updater_permissions(user)
+        except Exception as e:
+            logger.exception(e)
+            return False
 
 
 @register.filter
 def members(negotiation_part):
-    if negotiation_part is not None:
-        _members = [user.get_full_name() for user in negotiation_part.users]
-        return ', '.join(_members)
-    else:
-        return ''
+    with measure('tags.members'):
+        if negotiation_part is not None:
+            def render():
+                return ', '.join([user.get_full_name() for user in negotiation_part.users])
+            return cached_members('members', negotiation_part.pk, render)
+        else:
+            return ''
 
 
 @register.filter
 def clients(negotiable):
-    try:
-        negotiation = negotiable.negotiation
-    except Exception as e:
-        logger.exception(e)
-        return []
-    return members(negotiation.client)
+    with measure('tags.clients'):
+        try:
+            negotiation = negotiable.negotiation
+        except Exception as e:
+            logger.exception(e)
+            return []
+        return members(negotiation.client)
 
 
 @register.filter
 def sellers(negotiable):
-    try:
-        negotiation = negotiable.negotiation
-    except Exception as e:
-        logger.exception(e)
-        return []
-    return members(negotiation.seller)
+    with measure('tags.sellers'):
+        try:
+            negotiation = negotiable.negotiation
+        except Exception as e:
+            logger.exception(e)
+            return []
+        return members(negotiation.seller)
 
 
 @register.simple_tag
 def render_members(negotiation_part, profile_attribute_name='profile'):
-    if negotiation_part is not None:
-        _members = list()
-        for user in negotiation_part.users:
-            if (hasattr(user, profile_attribute_name)
-                    and hasattr(getattr(user, profile_attribute_name), 'get_absolute_url')):
-                tpl = "<a href='%s'>%s</a>"
-                profile = getattr(user, profile_attribute_name)
-                data = (profile.get_absolute_url(), user.get_full_name())
-            else:
-                tpl = "%s"
-                data = user.get_full_name()
-            _members.append(tpl % data)
-        return ', '.join(_members)
-    else:
-        return ''
+    with measure('tags.render_members'):
+        if negotiation_part is not None:
+            def render():
+                _members = list()
+                for user in negotiation_part.users:
+                    if (hasattr(user, profile_attribute_name)
+                            and hasattr(getattr(user, profile_attribute_name), 'get_absolute_url')):
+                        tpl = "<a href='%s'>%s</a>"
+                        profile = getattr(user, profile_attribute_name)
+                        data = (profile.get_absolute_url(), user.get_full_name())
+                    else:
+                        tpl = "%s"
+                        data = user.get_full_name()
+                    _members.append(tpl % data)
+                return ', '.join(_members)
+            return cached_members('render_members', negotiation_part.pk, render, profile_attribute_name)
+        else:
+            return ''
 
 
 @register.simple_tag
 def render_clients(negotiable):
-    try:
-        negotiation = negotiable.negotiation
-    except Exception as e:
-        logger.exception(e)
-        return ''
-    return render_members(negotiation.client)
+    with measure('tags.render_clients'):
+        try:
+            negotiation = negotiable.negotiation
+        except Exception as e:
+            logger.exception(e)
+            return ''
+        return render_members(negotiation.client)
 
 
 @register.simple_tag
 def render_sellers(negotiable):
-    try:
-        negotiation = negotiable.negotiation
-    except Exception as e:
-        logger.exception(e)
-        return ''
-    return render_members(negotiation.seller)
\ No newline at end of file
+    with measure('tags.render_sellers'):
+        try:
+            negotiation = negotiable.negotiation
+        except Exception as e:
+            logger.exception(e)
+            return ''
+        return render_members(negotiation.seller)
\ No newline at end of file
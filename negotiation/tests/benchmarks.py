@@ -0,0 +1,157 @@
+# coding=utf-8
+"""
+Benchmarks of the negotiation hot paths, measuring wall time and number of queries of each operation over a synthetic
+dataset (many negotiations, a long history and a large party group). They are not part of the regular test run:
+    python manage.py test negotiation.tests.benchmarks --settings=negotiation.tests.settings
+
+Results are written as JSON to NEGOTIATION_BENCHMARK_OUTPUT (negotiation_benchmark.json in the temporary directory by
+default) and compared against the stored baseline (NEGOTIATION_BENCHMARK_BASELINE) when it was measured with the same
+dataset sizes and database: using more queries than the baseline fails, and taking more than
+NEGOTIATION_BENCHMARK_TIME_TOLERANCE times its time is reported. The committed baseline (benchmark_baseline.json)
+bounds the queries of the default SQLite dataset, and a missing baseline or an operation missing from it fails
+(operations whose queries are still null in it are reported until measured). Set
+NEGOTIATION_BENCHMARK_UPDATE_BASELINE=1 to store the results as the new baseline. Dataset sizes are set with the
+NEGOTIATION_BENCHMARK_NEGOTIATIONS, NEGOTIATION_BENCHMARK_ROUNDS and NEGOTIATION_BENCHMARK_MEMBERS variables.
+See negotiation/tests/settings.py to run them on PostgreSQL.
+"""
+import json
+import os
+import sys
+import tempfile
+from timeit import default_timer
+from django.contrib.auth.models import User, Group
+from django.db import connection
+from django.template import Context, Template
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from models import Offer
+
+SIZES = {
+    'negotiations': int(os.environ.get('NEGOTIATION_BENCHMARK_NEGOTIATIONS', 200)),
+    'rounds': int(os.environ.get('NEGOTIATION_BENCHMARK_ROUNDS', 100)),
+    'members': int(os.environ.get('NEGOTIATION_BENCHMARK_MEMBERS', 200)),
+}
+OUTPUT = os.environ.get('NEGOTIATION_BENCHMARK_OUTPUT',
+                        os.path.join(tempfile.gettempdir(), 'negotiation_benchmark.json'))
+BASELINE = os.environ.get('NEGOTIATION_BENCHMARK_BASELINE',
+                          os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json'))
+UPDATE_BASELINE = os.environ.get('NEGOTIATION_BENCHMARK_UPDATE_BASELINE') == '1'
+TIME_TOLERANCE = float(os.environ.get('NEGOTIATION_BENCHMARK_TIME_TOLERANCE', 2.0))
+
+LIST_TEMPLATE = Template(
+    "{% load negotiation_tags %}"
+    "{% for offer in offers %}{% render_negotiation_options offer %}{% render_clients offer %}{% endfor %}"
+)
+PRELOADED_LIST_TEMPLATE = Template(
+    "{% load negotiation_tags %}{% preload_negotiations offers user %}"
+    "{% for offer in offers %}{% render_negotiation_options offer %}{% render_clients offer %}{% endfor %}"
+)
+
+
+class NegotiationBenchmark(TestCase):
+
+    def setUp(self):
+        self.results = {}
+        User.objects.bulk_create([User(username='member%s' % i) for i in range(SIZES['members'])])
+        members = list(User.objects.filter(username__startswith='member'))
+        self.client_user, self.seller = members[0], User.objects.create(username='seller')
+        team = Group.objects.create(name='Client team')
+        team.user_set.add(*members)
+
+        self.offers = [Offer.objects.create(amount=i, creator=self.client_user)
+                       for i in range(SIZES['negotiations'])]
+        Offer.objects.bulk_negotiate((offer, team, self.seller, "Initial offer.") for offer in self.offers)
+        self.long_offer = Offer.objects.get(pk=self.offers[0].pk)
+        for i in range(SIZES['rounds']):
+            user = self.seller if i % 2 == 0 else self.client_user
+            self.long_offer.counter_proposal(user, "Round %s." % i)
+
+    def fresh(self, offers):
+        # a new instance for each item (repeated offers included), with nothing cached yet
+        return [Offer.objects.get(pk=offer.pk) for offer in offers]
+
+    def measure(self, name, operation, arguments):
+        """
+        Runs 'operation' once for each one of 'arguments', and records the average time and number of queries.
+        """
+        arguments = list(arguments)
+        with CaptureQueriesContext(connection) as queries:
+            start = default_timer()
+            for argument in arguments:
+                operation(argument)
+            elapsed = default_timer() - start
+        self.results[name] = {
+            'seconds': elapsed / len(arguments),
+            'queries': float(len(queries)) / len(arguments),
+        }
+
+    def test_hot_paths(self):
+        batch = max(1, min(20, SIZES['negotiations'] // 5))
+        offers = self.offers[1:]
+        accepting, cancelling, modifying, countering, reading = [
+            offers[i * batch:(i + 1) * batch] for i in range(5)
+        ]
+
+        new_offers = [Offer.objects.create(amount=i, creator=self.client_user) for i in range(batch)]
+        self.measure('negotiate', lambda offer: offer.negotiate(self.client_user, self.seller, "New offer."),
+                     new_offers)
+        self.measure('accept', lambda offer: offer.accept(self.seller, "Accepted."), self.fresh(accepting))
+        self.measure('cancel', lambda offer: offer.cancel(self.seller, "Cancelled."), self.fresh(cancelling))
+        self.measure('modify', lambda offer: offer.modify_proposal(self.client_user, "Modified."),
+                     self.fresh(modifying))
+        self.measure('negotiate_transition', lambda offer: offer.counter_proposal(self.seller, "Countered."),
+                     self.fresh(countering))
+
+        self.measure('status_for', lambda offer: offer.status_for(self.client_user), self.fresh(reading))
+        self.measure('negotiation_options', lambda offer: offer.negotiation_options(self.seller),
+                     self.fresh(reading))
+        self.measure('history', lambda offer: list(offer.history()), self.fresh([self.long_offer] * batch))
+        self.measure('history_page', lambda offer: list(offer.history(limit=10)),
+                     self.fresh([self.long_offer] * batch))
+        self.measure('last_client_proposal', lambda offer: offer.last_client_proposal,
+                     self.fresh([self.long_offer] * batch))
+
+        self.measure('manager_negotiating', lambda i: Offer.objects.negotiating().count(), range(batch))
+        self.measure('manager_accepted', lambda i: Offer.objects.accepted().count(), range(batch))
+        self.measure('manager_cancelled', lambda i: Offer.objects.cancelled().count(), range(batch))
+
+        self.measure('list_tags', lambda offers: LIST_TEMPLATE.render(Context({
+            'offers': offers, 'user': self.seller
+        })), [self.fresh(reading)])
+        self.measure('preloaded_list_tags', lambda offers: PRELOADED_LIST_TEMPLATE.render(Context({
+            'offers': offers, 'user': self.seller
+        })), [self.fresh(reading)])
+
+        report = {'database': connection.vendor, 'sizes': SIZES, 'results': self.results}
+        with open(OUTPUT, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        if UPDATE_BASELINE:
+            with open(BASELINE, 'w') as baseline:
+                json.dump(report, baseline, indent=2, sort_keys=True)
+        else:
+            self.compare(report)
+
+    def compare(self, report):
+        self.assertTrue(os.path.exists(BASELINE), "No benchmark baseline at %s (store one with "
+                                                  "NEGOTIATION_BENCHMARK_UPDATE_BASELINE=1)." % BASELINE)
+        with open(BASELINE) as baseline_file:
+            baseline = json.load(baseline_file)
+        if (baseline['database'], baseline['sizes']) != (report['database'], report['sizes']):
+            sys.stderr.write("\nThe benchmark baseline was measured on a different dataset or database.\n")
+            return
+        query_regressions = []
+        for name, result in sorted(report['results'].items()):
+            expected = baseline['results'].get(name)
+            if expected is None:
+                query_regressions.append("%s: missing from the baseline" % name)
+                continue
+            if expected['queries'] is None:
+                sys.stderr.write("\n%s: %s queries (not measured in the baseline)" % (name, result['queries']))
+            elif result['queries'] > expected['queries']:
+                query_regressions.append("%s: %s queries (baseline: %s)" % (
+                    name, result['queries'], expected['queries']
+                ))
+            # baselines may only bound the queries (see 'note' in benchmark_baseline.json)
+            if expected.get('seconds') is not None and result['seconds'] > expected['seconds'] * TIME_TOLERANCE:
+                sys.stderr.write("\n%s: %.6fs (baseline: %.6fs)" % (name, result['seconds'], expected['seconds']))
+        self.assertEqual(query_regressions, [])
@@ -1,4 +1,5 @@
 # coding=utf-8
+import os
 
 SECRET_KEY = 'blabla'
 
@@ -40,4 +41,15 @@ DATABASES = {
     }
 }
 
+# Optionally, run the tests (and benchmarks) on PostgreSQL
+if os.environ.get('NEGOTIATION_TEST_DB') == 'postgresql':
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': os.environ.get('NEGOTIATION_TEST_DB_NAME', 'negotiation'),
+        'USER': os.environ.get('NEGOTIATION_TEST_DB_USER', ''),
+        'PASSWORD': os.environ.get('NEGOTIATION_TEST_DB_PASSWORD', ''),
+        'HOST': os.environ.get('NEGOTIATION_TEST_DB_HOST', ''),
+        'PORT': os.environ.get('NEGOTIATION_TEST_DB_PORT', ''),
+    }
+
 WORKFLOWS = {}
\ No newline at end of file
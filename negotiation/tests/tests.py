@@ -1,7 +1,8 @@
 # coding=utf-8
 from django.contrib.auth.models import User
 from django.test import TestCase
-from ..models import client_role
+from django.test.utils import override_settings
+from ..models import client_role, seller_role
 from models import Offer, OfferWithoutFreeze
 from utils import accept_transition, cancel_transition, negotiate_transition, modify_transition
 
@@ -95,3 +96,606 @@ class NegotiationTest(TestCase):
         initiator = self.offer.initiator
         self.assertEqual(initiator[0], self.users['client1'])
         self.assertEqual(initiator[1], client_role())
+
+    def test_summary(self):
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        negotiation = self.offer.negotiation
+        self.assertEqual(negotiation.rounds, 1)
+        self.assertEqual(negotiation.last_updater_user, self.users['client1'])
+        self.assertEqual(negotiation.last_updater_role, client_role())
+        self.assertIsNone(negotiation.latest_seller_proposal)
+
+        self.offer.amount = 950
+        self.offer.save()
+        self.offer.counter_proposal(self.users['seller'], "I can only do 950.")
+        negotiation = self.offer.negotiation
+        self.assertEqual(negotiation.rounds, 2)
+        self.assertEqual(negotiation.last_updater_user, self.users['seller'])
+        self.assertTrue(self.offer.is_last_updater(self.users['seller']))
+        self.assertEqual(self.offer.last_seller_proposal['content']['value'], 950)
+        self.assertEqual(self.offer.last_client_proposal['content']['value'], 1000)
+
+    def test_transition_before_backfill(self):
+        from ..models import Negotiation, NegotiationProposal
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        # a negotiation created before the proposals table: its history only lives in the workflow history
+        Negotiation.objects.filter(pk=self.offer.negotiation.pk).update(
+            rounds=0, last_updater_user=None, last_updater_role=None, latest_client_proposal=None
+        )
+        NegotiationProposal.objects.all().delete()
+
+        offer = Offer.objects.get(pk=self.offer.pk)
+        offer.amount = 950
+        offer.save()
+        self.assertTrue(offer.counter_proposal(self.users['seller'], "I can only do 950."))
+        negotiation = Negotiation.objects.get(pk=offer.negotiation.pk)
+        self.assertEqual(negotiation.rounds, 2)
+        self.assertEqual([item.notes for item in negotiation.history()],
+                         ["I can only do 950.", "I offer 1000 dollars."])
+        self.assertEqual(negotiation.last_client_proposal['content']['value'], 1000)
+        self.assertEqual(negotiation.last_seller_proposal['content']['value'], 950)
+
+    def test_backfill_command(self):
+        from django.core.management import call_command
+        from ..models import Negotiation
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        self.offer.amount = 950
+        self.offer.save()
+        self.offer.counter_proposal(self.users['seller'], "I can only do 950.")
+        bulk_offer = Offer.objects.create(amount=500, creator=self.users['client1'])
+        Offer.objects.bulk_negotiate([(bulk_offer, self.users['client1'], self.users['seller'], "500 dollars.")])
+
+        call_command('negotiation_backfill', all=True)
+        negotiation = Negotiation.objects.get(pk=self.offer.negotiation.pk)
+        self.assertEqual(negotiation.rounds, 2)
+        self.assertEqual(negotiation.last_client_proposal['content']['value'], 1000)
+        self.assertEqual(negotiation.last_seller_proposal['content']['value'], 950)
+        # negotiations without workflow history keep their proposals
+        bulk_negotiation = Offer.objects.get(pk=bulk_offer.pk).negotiation
+        self.assertEqual([item.notes for item in bulk_negotiation.history()], ["500 dollars."])
+
+    def test_membership(self):
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        client = self.offer.negotiation.client
+        self.assertTrue(client.has_member(self.users['client1']))
+        self.assertFalse(client.has_member(self.users['client2']))
+        # memoized answers are dropped as soon as the membership changes
+        client.user_set.add(self.users['client2'])
+        self.assertTrue(client.has_member(self.users['client2']))
+        self.assertIn(self.users['client2'], client.users)
+        self.users['client2'].groups.remove(client)
+        self.assertFalse(client.has_member(self.users['client2']))
+        self.assertNotIn(self.users['client2'], client.users)
+
+    def test_batch_statuses(self):
+        other_offer = Offer.objects.create(amount=500, creator=self.users['client2'])
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        other_offer.negotiate(self.users['client2'], self.users['seller'], "I offer 500 dollars.")
+        other_offer.counter_proposal(self.users['seller'], "I can only do 600.")
+
+        for user in self.users.values():
+            offers = Offer.objects.with_status_for(user)
+            self.assertEqual(len(offers), 2)
+            for offer in offers:
+                self.assertEqual(offer.negotiation_status, offer.status_for(user))
+                self.assertEqual(set(offer.negotiation_transitions), set(offer.negotiation_options(user)))
+
+    def test_with_negotiation(self):
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        Offer.objects.create(amount=500, creator=self.users['client2']).negotiate(
+            self.users['client2'], self.users['seller'], "I offer 500 dollars.")
+
+        offers = list(Offer.objects.with_negotiation_members())
+        with self.assertNumQueries(0):
+            for offer in offers:
+                negotiation = offer.negotiation
+                self.assertTrue(negotiation.is_seller(self.users['seller']))
+                self.assertEqual(negotiation.current_state.name, 'Negotiating')
+                self.assertEqual(negotiation.starter.pk, offer.creator_id)
+                self.assertEqual(negotiation.content, offer)
+
+    def test_constants_cache(self):
+        from .. import caching
+        caching.flush()
+        self.assertEqual(caching.warm(), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(client_role().name, 'Client')
+        caching.flush()
+        with self.assertNumQueries(1):
+            client_role()
+
+    def test_proposals(self):
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        self.offer.amount = 950
+        self.offer.save()
+        self.offer.counter_proposal(self.users['seller'], "I can only do 950.")
+        self.offer.accept(self.users['client1'], "ok, that's ok with me!")
+
+        proposals = self.offer.negotiation.proposals.order_by('created', 'id')
+        self.assertEqual([proposal.transition for proposal in proposals], ['Start', 'Negotiate', 'Accept'])
+        self.assertEqual([proposal.role for proposal in proposals], [client_role(), seller_role(), client_role()])
+        history = list(self.offer.history(recent_first=False))
+        self.assertEqual([item['notes'] for item in history],
+                         ["I offer 1000 dollars.", "I can only do 950.", "ok, that's ok with me!"])
+        self.assertEqual(history[1]['updater'], self.users['seller'])
+        self.assertEqual(self.offer.last_client_proposal['notes'], "ok, that's ok with me!")
+
+    def test_history_pagination(self):
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        for amount in (950, 900, 850):
+            self.offer.amount = amount
+            self.offer.save()
+            self.offer.modify_proposal(self.users['client1'], "I offer %s dollars now." % amount)
+
+        page = list(self.offer.history(limit=2))
+        self.assertEqual([item.content['value'] for item in page], [850, 900])
+        self.assertEqual(page[0]['notes'], "I offer 850 dollars now.")
+        self.assertEqual(page[0].transition, 'Modify')
+        self.assertTrue(all(item.updated <= page[0].updated for item in self.offer.history()))
+        older = list(self.offer.history(before=page[-1].updated))
+        self.assertTrue(all(item.updated < page[-1].updated for item in older))
+
+        # items sharing a timestamp across a page boundary are kept
+        self.offer.negotiation.proposals.update(created=page[0].updated)
+        pages, page = [], list(self.offer.history(limit=3))
+        while page:
+            pages.append([item.content['value'] for item in page])
+            page = list(self.offer.history(limit=3, before=page[-1].updated, before_id=page[-1].pk))
+        self.assertEqual(pages, [[850, 900, 950], [1000]])
+
+    def test_bulk_negotiate(self):
+        offers = [Offer.objects.create(amount=amount, creator=self.users['client1']) for amount in (100, 200, 300)]
+        items = [(offer, self.users['client1'], self.users['seller'], "I offer %s." % offer.amount) for offer in offers]
+        self.assertEqual(Offer.objects.bulk_negotiate(items + items[:1], chunk_size=2), 3)
+        self.assertEqual(Offer.objects.bulk_negotiate(items), 0)
+
+        for offer in Offer.objects.filter(pk__in=[offer.pk for offer in offers]):
+            self.assertTrue(offer.is_negotiating)
+            self.assertTrue(offer.is_client(self.users['client1']))
+            self.assertTrue(offer.is_last_updater(self.users['client1']))
+            self.assertEqual(offer.last_client_proposal['content']['value'], offer.amount)
+            self.assertIsNone(offer.last_seller_proposal)
+            self.assertEqual(offer.initiator, (self.users['client1'], client_role()))
+            self.assertEqual(len(offer.negotiation_options(self.users['seller'])), 3)
+            self.assertEqual(offer.negotiation_options(self.users['client1']), [modify_transition()])
+
+    def test_bulk_negotiate_group_names(self):
+        from django.db import IntegrityError
+        from ..models import Negotiation, NegotiationPart
+        offers = [Offer.objects.create(amount=amount, creator=self.users['client1']) for amount in (100, 200)]
+        Offer.objects.filter(pk__in=[offer.pk for offer in offers]).update(created=offers[0].created)
+        offers = list(Offer.objects.filter(pk__in=[offer.pk for offer in offers]))
+        self.assertEqual(str(offers[0]), str(offers[1]))
+        # like negotiate(), parts of different negotiables never share a group
+        items = [(offers[0], self.users['client1'], self.users['seller'], "I offer 100."),
+                 (offers[1], self.users['client2'], self.users['seller'], "I offer 200.")]
+        self.assertRaises(IntegrityError, Offer.objects.bulk_negotiate, items)
+        self.assertFalse(Negotiation.objects.exists())
+        NegotiationPart.objects.create(name="%s-client" % offers[0])
+        self.assertRaises(IntegrityError, Offer.objects.bulk_negotiate, items[:1])
+        self.assertFalse(Negotiation.objects.exists())
+
+    def test_reused_user_groups(self):
+        from django.core.management import call_command
+        from .. import models
+        other_offer = Offer.objects.create(amount=500, creator=self.users['client1'])
+        with override_settings(NEGOTIATION_REUSE_USER_GROUPS=True):
+            self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+            other_offer.negotiate(self.users['client1'], self.users['seller'], "I offer 500 dollars.")
+        self.assertEqual(self.offer.negotiation.client, other_offer.negotiation.client)
+        self.assertEqual(self.offer.negotiation.seller, other_offer.negotiation.seller)
+        self.assertTrue(other_offer.is_client(self.users['client1']))
+
+        orphan = models.NegotiationPart.for_user(self.users['client2'], "Orphan-client")
+        # groups not created by the application are kept, whatever their name and number of members
+        site_groups = [models.NegotiationPart.objects.create(name=name) for name in ("acme-client", "acme-seller")]
+        site_groups[1].user_set.add(self.users['client2'])
+        call_command('negotiation_sweep_groups')
+        self.assertFalse(models.NegotiationPart.objects.filter(pk=orphan.pk).exists())
+        self.assertEqual(models.NegotiationPart.objects.filter(pk__in=[group.pk for group in site_groups]).count(), 2)
+        self.assertTrue(models.NegotiationPart.objects.filter(pk=self.offer.negotiation.client.pk).exists())
+
+    @override_settings(NEGOTIATION_TURN_BASED=True)
+    def test_turn_based(self):
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        self.assertEqual(self.offer.negotiation.turn, seller_role())
+        self.assertEqual(self.offer.negotiation_options(self.users['client1']), [modify_transition()])
+        self.assertEqual(len(self.offer.negotiation_options(self.users['seller'])), 3)
+        self.assertFalse(self.offer.accept(self.users['client1'], "accepting my own offer"))
+
+        self.offer.amount = 950
+        self.offer.save()
+        self.assertTrue(self.offer.counter_proposal(self.users['seller'], "I can only do 950."))
+        self.assertEqual(self.offer.negotiation.turn, client_role())
+        self.assertEqual(self.offer.negotiation_options(self.users['seller']), [modify_transition()])
+        self.assertIn(accept_transition(), self.offer.negotiation_options(self.users['client1']))
+        self.assertTrue(self.offer.accept(self.users['client1'], "ok, that's ok with me!"))
+        self.assertTrue(self.offer.is_accepted)
+        self.assertEqual(self.offer.negotiation_options(self.users['seller']), [])
+
+    def test_turn_before_backfill(self):
+        from .. import models
+        with override_settings(NEGOTIATION_TURN_BASED=True):
+            self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        # not backfilled yet: the turn is read from the workflow history, even when the setting was turned off since
+        models.Negotiation.objects.filter(pk=self.offer.negotiation.pk).update(
+            rounds=0, last_updater_user=None, last_updater_role=None, latest_client_proposal=None
+        )
+        models.NegotiationProposal.objects.all().delete()
+        offer = Offer.objects.get(pk=self.offer.pk)
+        self.assertEqual(offer.negotiation.turn, seller_role())
+        self.assertEqual(offer.negotiation_options(self.users['client1']), [modify_transition()])
+        self.assertEqual(len(offer.negotiation_options(self.users['seller'])), 3)
+        self.assertFalse(offer.accept(self.users['client1'], "accepting my own offer"))
+        self.assertTrue(offer.accept(self.users['seller'], "ok, that's ok with me!"))
+
+    def test_transition_query_budget(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from ..models import TRANSITION_QUERY_BUDGET
+
+        def run(transition, method, user, notes):
+            offer = Offer.objects.get(pk=self.offer.pk)  # nothing cached yet but the negotiation
+            negotiation = offer.negotiation
+            workflow_method_name = 'do_%s' % transition.lower()
+            workflow_method, workflow_queries = getattr(negotiation, workflow_method_name), []
+
+            def measured_workflow_method(*args):
+                with CaptureQueriesContext(connection) as captured:
+                    result = workflow_method(*args)
+                workflow_queries.extend(query['sql'] for query in captured)
+                return result
+            setattr(negotiation, workflow_method_name, measured_workflow_method)
+            try:
+                with CaptureQueriesContext(connection) as captured:
+                    self.assertTrue(getattr(offer, method)(user, notes))
+            finally:
+                delattr(negotiation, workflow_method_name)
+            self.assertLessEqual(len(captured) - len(workflow_queries), TRANSITION_QUERY_BUDGET[transition])
+            # only the state and summary columns are written
+            updates = [sql for sql in workflow_queries if sql.startswith('UPDATE') and 'starter_id' in sql]
+            self.assertEqual(updates, [])
+            return offer
+
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        run('Modify', 'modify_proposal', self.users['client1'], "I offer 900 dollars now.")
+        run('Negotiate', 'counter_proposal', self.users['seller'], "I can only do 950.")
+        offer = run('Accept', 'accept', self.users['client1'], "ok, that's ok with me!")
+        self.assertEqual(offer.negotiation.notes, "ok, that's ok with me!")
+        self.assertEqual(Offer.objects.get(pk=self.offer.pk).negotiation.notes, "ok, that's ok with me!")
+
+    def test_refused_transition(self):
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        negotiation = self.offer.negotiation
+        self.assertFalse(self.offer.counter_proposal(self.users['client1'], "Negotiating with myself."))
+        self.assertEqual(negotiation.rounds, 1)
+        self.assertEqual(negotiation.notes, "I offer 1000 dollars.")
+        self.assertEqual(negotiation.proposals.count(), 1)
+
+    def test_concurrent_transitions(self):
+        from ..models import Negotiation, StaleNegotiation
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        seller_view = Negotiation.objects.get(pk=self.offer.negotiation.pk)
+        self.offer.modify_proposal(self.users['client1'], "I offer 900 dollars now.")
+
+        # the seller acts on the negotiation as it was before the modification
+        self.assertRaises(StaleNegotiation, seller_view.accept, self.users['seller'], "ok!")
+        self.assertTrue(seller_view.is_negotiating)
+        self.assertTrue(seller_view.retrying('accept', self.users['seller'], "ok!"))
+        self.assertTrue(seller_view.is_accepted)
+        self.assertEqual(seller_view.last_client_proposal['notes'], "I offer 900 dollars now.")
+
+    def test_preload_negotiations(self):
+        from ..templatetags.negotiation_tags import preload_negotiations, clients, render_sellers
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        Offer.objects.create(amount=500, creator=self.users['client2']).negotiate(
+            self.users['client2'], self.users['seller'], "I offer 500 dollars.")
+        Offer.objects.create(amount=100, creator=self.users['client2'])  # not negotiated
+
+        offers = list(Offer.objects.all())
+        preload_negotiations(offers, self.users['seller'])
+        with self.assertNumQueries(0):
+            for offer in offers:
+                if offer.negotiation is None:
+                    self.assertIsNone(offer.status_for(self.users['seller']))
+                    continue
+                self.assertIn(offer.creator_id, [user.pk for user in offer.negotiation.client.users])
+                clients(offer)
+                render_sellers(offer)
+                self.assertEqual(offer.status_for(self.users['seller'])[1], 'pending')
+                self.assertEqual(len(offer.negotiation_options(self.users['seller'])), 3)
+
+    def test_cached_members(self):
+        from django.core.cache import cache
+        from ..templatetags.negotiation_tags import clients, render_clients
+        cache.clear()
+        self.users['client1'].first_name, self.users['client2'].first_name = 'Pedro', 'Juan'
+        self.users['client1'].save()
+        self.users['client2'].save()
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        self.assertEqual(clients(self.offer), 'Pedro')
+        self.assertEqual(render_clients(self.offer), 'Pedro')
+        offer = Offer.objects.with_negotiation().get(pk=self.offer.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(clients(offer), 'Pedro')
+
+        self.users['client1'].first_name = 'Peter'
+        self.users['client1'].save()
+        self.assertEqual(clients(self.offer), 'Peter')
+        self.offer.negotiation.client.user_set.add(self.users['client2'])
+        self.assertEqual(sorted(render_clients(self.offer).split(', ')), ['Juan', 'Peter'])
+
+    def test_instrumentation(self):
+        from ..instrumentation import configure, MemorySink
+        from ..templatetags.negotiation_tags import clients
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        sink = configure('memory')
+        try:
+            self.assertIsInstance(sink, MemorySink)
+            self.offer.accept(self.users['seller'], "ok!")
+            clients(self.offer)
+        finally:
+            configure(None)
+        self.assertIn('negotiable.tests.offer.accept', sink.names())
+        self.assertIn('negotiation.accept', sink.names())
+        self.assertIn('tags.clients', sink.names())
+        accept_queries = [queries for name, seconds, queries in sink.timings if name == 'negotiation.accept']
+        self.assertTrue(accept_queries[0] > 0)
+        self.assertTrue(sum(value for name, value in sink.counts.items() if name.startswith('cache.')) > 0)
+
+        # disabled, nothing else is measured
+        self.offer.status_for(self.users['seller'])
+        self.assertNotIn('negotiable.tests.offer.status_for', sink.names())
+
+    def test_state_counts(self):
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        other_offer = Offer.objects.create(amount=500, creator=self.users['client2'])
+        other_offer.negotiate(self.users['client2'], self.users['seller'], "I offer 500 dollars.")
+        Offer.objects.create(amount=100, creator=self.users['client2'])  # not negotiated
+        other_offer.accept(self.users['seller'], "ok!")
+
+        self.assertEqual(Offer.objects.negotiating().get(), self.offer)
+        self.assertEqual(Offer.objects.accepted().get(), other_offer)
+        self.assertEqual(Offer.objects.cancelled().count(), 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(Offer.objects.state_counts(), {'Negotiating': 1, 'Accepted': 1, 'Cancelled': 0})
+        self.assertEqual(Offer.objects.filter(amount__gt=600).state_counts()['Negotiating'], 1)
+
+    def test_inbox(self):
+        from django.core.cache import cache
+        from ..models import Negotiation
+        cache.clear()
+        client1, client2, seller = self.users['client1'], self.users['client2'], self.users['seller']
+        self.offer.negotiate(client1, seller, "I offer 1000 dollars.")
+        negotiation = self.offer.negotiation
+        self.assertEqual(list(Negotiation.objects.pending_for(seller)), [negotiation])
+        self.assertEqual(Negotiation.objects.pending_count_for(seller), 1)
+        self.assertEqual(Negotiation.objects.pending_count_for(client1), 0)
+
+        self.offer.modify_proposal(client1, "I offer 900 dollars now.")
+        self.assertEqual(Negotiation.objects.pending_count_for(seller), 1)
+        self.offer.counter_proposal(seller, "I can only do 950.")
+        self.assertEqual(Negotiation.objects.pending_count_for(client1), 1)
+        self.assertEqual(Negotiation.objects.pending_count_for(seller), 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(Negotiation.objects.pending_count_for(seller), 0)
+
+        # members joining or leaving the part expected to act
+        negotiation.client.user_set.add(client2)
+        self.assertEqual(list(Negotiation.objects.pending_for(client2)), [negotiation])
+        self.assertEqual(Negotiation.objects.pending_count_for(client2), 1)
+        client2.groups.clear()
+        self.assertEqual(Negotiation.objects.pending_count_for(client2), 0)
+
+        # the cached counts of the removed members are forgotten too
+        negotiation.client.user_set.add(client2)
+        self.assertEqual(Negotiation.objects.pending_count_for(client2), 1)
+        negotiation.client.user_set.remove(client2)
+        self.assertEqual(Negotiation.objects.pending_count_for(client2), 0)
+        client2.groups.add(negotiation.client)
+        self.assertEqual(Negotiation.objects.pending_count_for(client2), 1)
+        client2.groups.remove(negotiation.client)
+        self.assertEqual(Negotiation.objects.pending_count_for(client2), 0)
+        negotiation.client.user_set.clear()
+        self.assertEqual(Negotiation.objects.pending_count_for(client1), 0)
+        negotiation.client.user_set.add(client1)
+        self.assertEqual(Negotiation.objects.pending_count_for(client1), 1)
+
+        self.offer.accept(client1, "ok, that's ok with me!")
+        self.assertEqual(Negotiation.objects.pending_count_for(client1), 0)
+        self.assertEqual(Negotiation.objects.pending_count_for(seller), 0)
+
+    def test_inbox_before_backfill(self):
+        from django.core.cache import cache
+        from .. import models
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        # not backfilled yet: there are no inbox entries, and a modification adds them along with the summary
+        models.Negotiation.objects.filter(pk=self.offer.negotiation.pk).update(
+            rounds=0, last_updater_user=None, last_updater_role=None, latest_client_proposal=None
+        )
+        models.NegotiationProposal.objects.all().delete()
+        models.NegotiationInbox.objects.all().delete()
+        cache.clear()
+        offer = Offer.objects.get(pk=self.offer.pk)
+        self.assertEqual(models.Negotiation.objects.pending_count_for(self.users['seller']), 0)
+        self.assertTrue(offer.modify_proposal(self.users['client1'], "I offer 900 dollars now."))
+        self.assertEqual(list(models.Negotiation.objects.pending_for(self.users['seller'])), [offer.negotiation])
+        self.assertEqual(models.Negotiation.objects.pending_count_for(self.users['seller']), 1)
+
+    def test_for_user(self):
+        from ..models import Negotiation
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        other_offer = Offer.objects.create(amount=500, creator=self.users['seller'])
+        other_offer.negotiate(self.users['seller'], self.users['client1'], "I offer 500 dollars.")
+        negotiation, other_negotiation = self.offer.negotiation, other_offer.negotiation
+
+        with self.assertNumQueries(1):
+            self.assertEqual(set(Negotiation.objects.for_user(self.users['client1'], Offer)),
+                             {negotiation, other_negotiation})
+        self.assertEqual(list(Negotiation.objects.for_user(self.users['client1'], role='client')), [negotiation])
+        self.assertEqual(list(Negotiation.objects.client_for_model(self.users['seller'], Offer)), [other_negotiation])
+        self.assertEqual(list(Negotiation.objects.seller_for_model(self.users['seller'], Offer)), [negotiation])
+        self.assertEqual(Negotiation.objects.for_user(self.users['client2']).count(), 0)
+        self.assertRaises(ValueError, Negotiation.objects.for_user, self.users['client1'], role='buyer')
+
+    def test_export(self):
+        import gzip
+        import io
+        import json
+        from ..export import export_negotiations
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        self.offer.counter_proposal(self.users['seller'], "I can only do 950.")
+        other_offer = Offer.objects.create(amount=500, creator=self.users['client2'])
+        other_offer.negotiate(self.users['client2'], self.users['seller'], "I offer 500 dollars.")
+
+        output = io.BytesIO()
+        with self.assertNumQueries(3):  # a chunk of negotiations, their proposals, and the empty next chunk
+            count, watermark = export_negotiations(output, chunk_size=2)
+        records = [json.loads(line) for line in output.getvalue().decode('utf-8').splitlines()]
+        self.assertEqual(count, 2)
+        self.assertEqual([record['id'] for record in records],
+                         [self.offer.negotiation.pk, other_offer.negotiation.pk])
+        self.assertEqual([item['notes'] for item in records[0]['history']],
+                         ["I offer 1000 dollars.", "I can only do 950."])
+        self.assertEqual([item['role'] for item in records[0]['history']], ['client', 'seller'])
+        self.assertEqual(records[0]['history'][1]['transition'], 'Negotiate')
+        self.assertEqual(records[1]['history'][0]['content'], {'value': 500})
+
+        # incremental export, compressed
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_output:
+            self.assertEqual(export_negotiations(gzip_output, since=watermark), (0, watermark))
+
+    def test_archive(self):
+        from django.contrib.contenttypes.models import ContentType
+        from permissions.models import ObjectPermission
+        from ..archive import archivable, archive_negotiations
+        from ..management.commands.negotiation_sweep_groups import Command as SweepGroups
+        from ..models import Negotiation, NegotiationArchive, STATUSES
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        self.offer.counter_proposal(self.users['seller'], "I can only do 950.")
+        self.offer.accept(self.users['client1'], "ok, that's ok with me!")
+        other_offer = Offer.objects.create(amount=500, creator=self.users['client2'])
+        other_offer.negotiate(self.users['client2'], self.users['seller'], "I offer 500 dollars.")
+        client_pk = self.offer.negotiation.client_id
+
+        self.assertEqual(archive_negotiations(archivable(days=0).select_related('current_state')), 1)
+        self.assertEqual(Negotiation.objects.get().content, other_offer)
+        self.assertFalse(ObjectPermission.objects.filter(
+            content_type=ContentType.objects.get_for_model(Negotiation)
+        ).exclude(content_id=other_offer.negotiation.pk).exists())
+
+        offer = Offer.objects.get(pk=self.offer.pk)
+        self.assertIsInstance(offer.negotiation, NegotiationArchive)
+        self.assertTrue(offer.is_accepted)
+        self.assertEqual(offer.status_for(self.users['seller']), STATUSES['ACCEPTED'])
+        self.assertEqual(offer.negotiation_options(self.users['seller']), [])
+        self.assertEqual([item['notes'] for item in offer.history()],
+                         ["ok, that's ok with me!", "I can only do 950.", "I offer 1000 dollars."])
+        self.assertEqual(next(offer.history(recent_first=False)).updater, self.users['client1'])
+        self.assertEqual(next(offer.history(limit=1)).content, {'value': 1000})
+        self.assertEqual(offer.last_client_proposal['notes'], "ok, that's ok with me!")
+        self.assertEqual(offer.last_seller_proposal.updater, self.users['seller'])
+        self.assertEqual(offer.last_counterpart_proposal_for(self.users['seller'])['content'], {'value': 1000})
+        self.assertEqual(offer.initiator, (self.users['client1'], client_role()))
+        self.assertFalse(offer.negotiation.has_last_updater_permissions(self.users['seller']))
+        # archived negotiations are still filtered and counted by state
+        self.assertEqual(Offer.objects.state_counts(), {'Negotiating': 1, 'Accepted': 1, 'Cancelled': 0})
+        self.assertEqual(list(Offer.objects.accepted()), [offer])
+        self.assertEqual(Offer.objects.cancelled().count(), 0)
+        self.assertEqual(list(Offer.objects.negotiating()), [other_offer])
+
+        statuses = Negotiation.objects.statuses_for(self.users['seller'], Offer.objects.all())
+        self.assertEqual(statuses[offer.pk], (STATUSES['ACCEPTED'], []))
+        self.assertNotIn(client_pk, SweepGroups().orphaned_groups().values_list('pk', flat=True))
+
+    def test_missing_negotiation(self):
+        offer = Offer.objects.get(pk=self.offer.pk)
+        with self.assertNumQueries(2):  # the negotiations, then the archives
+            self.assertIsNone(offer.negotiation)
+        with self.assertNumQueries(0):
+            self.assertIsNone(offer.negotiation)
+        offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        self.assertTrue(offer.is_negotiating)
+
+    def test_delta_proposals(self):
+        from .. import models
+        from ..export import iter_negotiations
+        with override_settings(NEGOTIATION_SNAPSHOT_INTERVAL=3):
+            self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+            for amount, method, user in ((900, 'modify_proposal', 'client1'), (950, 'counter_proposal', 'seller'),
+                                         (920, 'modify_proposal', 'seller'), (930, 'counter_proposal', 'client1')):
+                self.offer.amount = amount
+                self.offer.save()
+                self.assertTrue(getattr(self.offer, method)(self.users[user], "%s dollars." % amount))
+
+        negotiation = models.Negotiation.objects.get(pk=self.offer.negotiation.pk)
+        self.assertEqual(list(negotiation.proposals.order_by('id').values_list('is_delta', flat=True)),
+                         [False, True, True, False, True])
+        self.assertEqual([item.content['value'] for item in negotiation.history()], [930, 920, 950, 900, 1000])
+        self.assertEqual([item.content['value'] for item in negotiation.history(recent_first=False)],
+                         [1000, 900, 950, 920, 930])
+        self.assertEqual(next(negotiation.history(limit=1)).content, {'value': 930})
+        self.assertEqual(negotiation.last_client_proposal['content'], {'value': 930})
+        self.assertEqual(negotiation.last_seller_proposal['content'], {'value': 920})
+        self.assertEqual([item['content']['value'] for item in next(iter_negotiations())['history']],
+                         [1000, 900, 950, 920, 930])
+
+    def test_serializers(self):
+        from .. import models, serializers
+        for name in ('zlib-json', 'msgpack'):
+            if name == 'msgpack' and serializers.msgpack is None:
+                continue
+            serializer = serializers.SERIALIZERS[name]()
+            self.assertTrue(serializer.dumps({'value': 1}).startswith(serializer.marker))
+            self.assertEqual(serializers.loads(serializer.dumps({'value': u'ü', 'list': [1, None]})),
+                             {'value': u'ü', 'list': [1, None]})
+
+        # payloads written before changing the serializer stay readable
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        serializers.configure('zlib-json')
+        try:
+            self.offer.amount = 900
+            self.offer.save()
+            self.assertTrue(self.offer.counter_proposal(self.users['seller'], "900 dollars."))
+        finally:
+            serializers.configure('json')
+        negotiation = models.Negotiation.objects.get(pk=self.offer.negotiation.pk)
+        self.assertTrue(negotiation.proposals.order_by('-id')[0].content.startswith('z:'))
+        self.assertEqual([(item.content['value'], item.notes) for item in negotiation.history()],
+                         [(900, "900 dollars."), (1000, "I offer 1000 dollars.")])
+        self.assertEqual(negotiation.last_seller_proposal['content'], {'value': 900})
+
+    def test_transition_matrix(self):
+        from ..models import Negotiation, TRANSITION_MATRIX
+        self.assertEqual(TRANSITION_MATRIX[('Negotiating', 'seller', 'seller')], ('Accept', 'Cancel', 'Negotiate'))
+        self.assertEqual(TRANSITION_MATRIX[('Negotiating', 'seller', 'client')], ('Modify',))
+        self.assertEqual(TRANSITION_MATRIX[('Negotiating', 'client', None)], ())
+        self.assertEqual(len(TRANSITION_MATRIX[('Negotiating', 'client', 'both')]), 4)
+
+        self.offer.negotiate(self.users['client1'], self.users['seller'], "I offer 1000 dollars.")
+        for amount, method, user in ((900, 'counter_proposal', 'seller'), (950, 'modify_proposal', 'seller'),
+                                     (950, 'accept', 'client1')):
+            negotiation = Negotiation.objects.get(pk=self.offer.negotiation.pk)
+            for other in self.users.values():
+                # the matrix agrees with the workflow permission checks
+                self.assertEqual(set(negotiation.allowed_transitions(other)),
+                                 set(negotiation.get_allowed_transitions(other)))
+            # the side of each user is cached until the next transition
+            self.assertEqual(negotiation.side_of(self.users['client1']), 'client')
+            with self.assertNumQueries(0):
+                self.assertEqual(negotiation.side_of(self.users['client1']), 'client')
+                self.assertTrue(negotiation.is_client(self.users['client1']))
+                self.assertFalse(negotiation.is_seller(self.users['client1']))
+            self.offer.amount = amount
+            self.offer.save()
+            self.assertTrue(getattr(self.offer, method)(self.users[user], "%s dollars." % amount))
+        negotiation = Negotiation.objects.get(pk=self.offer.negotiation.pk)
+        self.assertEqual(negotiation.allowed_transitions(self.users['seller']), [])
+
+        # the cached sides follow the membership changes of the parts
+        self.assertIsNone(negotiation.side_of(self.users['client2']))
+        negotiation.seller.user_set.add(self.users['client2'])
+        self.assertEqual(negotiation.side_of(self.users['client2']), 'seller')
+        negotiation.client.user_set.add(self.users['client2'])
+        self.assertEqual(negotiation.side_of(self.users['client2']), 'both')